@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+'''Benchmark the vidutils tools on synthetic media made with ffmpeg's lavfi
+sources, recording wall time, peak memory, bytes written and peak scratch
+space for each tool across a matrix of media sizes.'''
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each scenario gives the tool to run and a function making its arguments from
+# the input filename and the media duration in seconds.
+SCENARIOS = {
+    'split' : ('split', lambda f, d: [f, seconds_str(d / 3),
+        seconds_str(2 * d / 3), '-p', 'part']),
+    'split-parallel' : ('split', lambda f, d: [f, '-p', 'part', '-j', '4',
+        '-n', str(d / 4 / 60)]),
+    'merge' : ('merge', lambda f, d: [f, f, '-o', 'out.mp4', '-d',
+        '00:00:02']),
+    'merge-accurate' : ('merge', lambda f, d: [f, f, '-o', 'out.mp4', '-d',
+        '00:00:02', '-a', '-z']),
+    'volume' : ('volume', lambda f, d: [f, '00:00:01-00:00:03',
+        mid_segment(d), '-o', 'out.mp4', '-c', '1']),
+    'volume-splice' : ('volume', lambda f, d: [f, '00:00:01-00:00:03',
+        mid_segment(d), '-o', 'out.mp4', '-c', '1', '-S']),
+}
+
+def seconds_str(seconds):
+    '''Format *seconds* as HH:MM:SS.SS.'''
+
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:02.0f}:{:02.0f}:{:05.2f}'.format(hours, minutes, seconds)
+
+def mid_segment(duration):
+    '''Return a two second audio segment from the middle of the media.'''
+
+    return '{}-{}'.format(seconds_str(duration / 2),
+                          seconds_str(duration / 2 + 2))
+
+def generate_media(media_dir, duration, resolution, gop, audio_streams,
+                   fps=30):
+    '''Make a deterministic test video in *media_dir* with a testsrc2 video
+    stream and *audio_streams* sine audio streams, reusing the file if it was
+    already made. Returns the filename.'''
+
+    filename = os.path.join(media_dir, 'test-{}s-{}-g{}-a{}.mp4'.format(
+        duration, resolution, gop, audio_streams))
+    if os.path.exists(filename):
+        return filename
+
+    args = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i',
+            'testsrc2=size={}:rate={}:duration={}'.format(resolution, fps,
+                                                          duration)]
+    for i in range(audio_streams):
+        args += ['-f', 'lavfi', '-i', 'sine=frequency={}:duration={}'.format(
+            440 + 110 * i, duration)]
+    args += ['-map', '0:v']
+    for i in range(audio_streams):
+        args += ['-map', '{}:a'.format(i + 1)]
+    args += ['-c:v', 'libx264', '-preset', 'veryfast', '-g', str(gop),
+             '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-threads', '1',
+             '-fflags', '+bitexact', '-flags', '+bitexact', '-y',
+             filename + '.tmp.mp4']
+    subprocess.run(args, check=True)
+    os.replace(filename + '.tmp.mp4', filename)
+    return filename
+
+def dir_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                pass
+    return total
+
+def run_scenario(name, input_file, duration):
+    '''Run the scenario *name* on *input_file* in a scratch directory and
+    return its measurements.'''
+
+    tool, make_args = SCENARIOS[name]
+    work_dir = tempfile.mkdtemp(prefix='vidutils-bench-')
+    metrics_file = os.path.join(work_dir, 'metrics.jsonl')
+    env = dict(os.environ, VIDUTILS_METRICS=metrics_file,
+               VIDUTILS_CACHE_DIR=os.path.join(work_dir, 'cache'),
+               PYTHONPATH=ROOT)
+    args = [sys.executable, '-m', 'vidutils.' + tool] + make_args(input_file,
+                                                                  duration)
+
+    # Track the scratch space used while the tool runs.
+    peak = [0]
+    running = threading.Event()
+    running.set()
+    def watch():
+        while running.is_set():
+            peak[0] = max(peak[0], dir_size(work_dir))
+            time.sleep(0.05)
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+
+    begin = time.monotonic()
+    proc = subprocess.Popen(args, cwd=work_dir, env=env,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    # The usage from wait4() covers the tool and the ffmpeg processes it ran.
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall_time = time.monotonic() - begin
+    running.clear()
+    watcher.join()
+
+    bytes_written = 0
+    if os.path.exists(metrics_file):
+        with open(metrics_file, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['event'] == 'stage' and record['bytes_out']:
+                    bytes_written += record['bytes_out']
+    shutil.rmtree(work_dir)
+
+    return {'wall_time' : wall_time, 'peak_rss_kb' : usage.ru_maxrss,
+            'bytes_written' : bytes_written, 'peak_scratch_bytes' : peak[0],
+            'ok' : os.waitstatus_to_exitcode(status) == 0}
+
+def compare(results, baseline, threshold):
+    '''Compare the wall times in *results* against *baseline*, printing each
+    change and returning True if any is slower by more than *threshold*
+    (a fraction) or failed. Runs that failed in *baseline* aren't compared.'''
+
+    regressed = False
+    for key, result in sorted(results.items()):
+        if key not in baseline or not baseline[key].get('ok', True):
+            continue
+        if not result['ok']:
+            print('{}: FAILED'.format(key))
+            regressed = True
+            continue
+        old = baseline[key]['wall_time']
+        change = (result['wall_time'] - old) / old if old else 0
+        mark = ''
+        if change > threshold:
+            mark = ' REGRESSION'
+            regressed = True
+        print('{}: {:.2f}s -> {:.2f}s ({:+.1%}){}'.format(key, old,
+              result['wall_time'], change, mark))
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', dest='output', metavar='<filename>',
+            default='bench-results.json', help='Write results to this file')
+    parser.add_argument('-b', dest='baseline', metavar='<filename>',
+            default=None, help='Compare results against this results file')
+    parser.add_argument('-t', dest='threshold', metavar='N', type=float,
+            default=0.1, help='Fraction of slowdown counted as a regression')
+    parser.add_argument('-d', dest='durations', metavar='N[,N...]',
+            default='30,120', help='Media durations in seconds')
+    parser.add_argument('-r', dest='resolutions', metavar='WxH[,WxH...]',
+            default='640x360,1280x720', help='Media resolutions')
+    parser.add_argument('-g', dest='gop', metavar='N', type=int, default=60,
+            help='GOP size of the media in frames')
+    parser.add_argument('-a', dest='audio_streams', metavar='N', type=int,
+            default=2, help='Number of audio streams in the media')
+    parser.add_argument('-s', dest='scenarios', metavar='NAME[,NAME...]',
+            default=','.join(SCENARIOS), help='Scenarios to run')
+    parser.add_argument('-m', dest='media_dir', metavar='<dir>',
+            default=os.path.join(tempfile.gettempdir(), 'vidutils-bench-media'),
+            help='Directory for the generated media')
+    args = parser.parse_args()
+
+    os.makedirs(args.media_dir, exist_ok=True)
+    results = {}
+    for duration in [int(d) for d in args.durations.split(',')]:
+        for resolution in args.resolutions.split(','):
+            input_file = generate_media(args.media_dir, duration, resolution,
+                                        args.gop, args.audio_streams)
+            for name in args.scenarios.split(','):
+                key = '{}/{}s/{}'.format(name, duration, resolution)
+                results[key] = run_scenario(name, input_file, duration)
+                print('{}: {:.2f}s, {} KiB peak RSS, {} bytes written, {} '
+                      'bytes peak scratch{}'.format(key,
+                      results[key]['wall_time'], results[key]['peak_rss_kb'],
+                      results[key]['bytes_written'],
+                      results[key]['peak_scratch_bytes'],
+                      '' if results[key]['ok'] else ' (FAILED)'))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    failed = not all(r['ok'] for r in results.values())
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,7 @@ setup(
     author='gammafunk',
     author_email='gammafunk@gmail.com',
     packages=['vidutils'],
-    extras_require={},
+    extras_require={'yaml': ['PyYAML'], 'analysis': ['numpy']},
     setup_requires = [],
     data_files=[],
     entry_points={
@@ -30,6 +30,7 @@ setup(
             'vid-volume=vidutils.volume:main',
             'vid-merge=vidutils.merge:main',
             'vid-split=vidutils.split:main',
+            'vid-batch=vidutils.batch:main',
         ],
     },
     classifiers=[
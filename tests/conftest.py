@@ -0,0 +1,61 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from vidutils import common
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+needs_ffmpeg = pytest.mark.skipif(
+    not shutil.which('ffmpeg') or not shutil.which('ffprobe'),
+    reason='needs ffmpeg and ffprobe')
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    '''Keep probe results out of the user's cache.'''
+
+    monkeypatch.setattr(common, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(common, '_cache_memo', {})
+    monkeypatch.setenv('VIDUTILS_CACHE_DIR', str(tmp_path / 'cache'))
+
+def make_clip(filename, seconds, fps=30, frequency=440, audio_codec='aac'):
+    '''Write a 160x120 H.264 clip with B-frames and two-second GOPs and a sine
+    tone encoded with *audio_codec*.'''
+
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i',
+                    'testsrc=size=160x120:rate={}:duration={}'.format(
+                        fps, seconds),
+                    '-f', 'lavfi', '-i', 'sine=frequency={}:duration={}'.format(
+                        frequency, seconds),
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-bf', '3',
+                    '-g', str(2 * fps), '-pix_fmt', 'yuv420p', '-c:a',
+                    audio_codec, '-shortest', '-y', filename], check=True)
+    return filename
+
+@pytest.fixture(scope='session')
+def clips(tmp_path_factory):
+    '''Two ten-second clips at 30 fps.'''
+
+    path = tmp_path_factory.mktemp('clips')
+    return [make_clip(str(path / 'a.mp4'), 10),
+            make_clip(str(path / 'b.mp4'), 10, frequency=660)]
+
+def frame_hashes(filename):
+    '''Return the MD5 of each decoded video frame of *filename*.'''
+
+    result = subprocess.run(['ffmpeg', '-v', 'error', '-i', filename, '-map',
+                             '0:v:0', '-f', 'framemd5', '-'],
+                            stdout=subprocess.PIPE, check=True)
+    return [line.rsplit(',', 1)[1].strip()
+            for line in result.stdout.decode('utf-8').splitlines()
+            if not line.startswith('#')]
+
+def run_tool(module, args, cwd):
+    '''Run the main() of the vidutils *module* with *args* in *cwd*.'''
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    subprocess.run([sys.executable, '-m', 'vidutils.' + module] + args,
+                   cwd=str(cwd), env=env, check=True)
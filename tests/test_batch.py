@@ -0,0 +1,11 @@
+from conftest import ROOT
+from vidutils import batch
+
+def test_run_job(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PYTHONPATH', ROOT)
+    job = {'name' : 'split', 'tool' : 'split', 'args' : ['--help']}
+    assert batch.run_job(job, 1, 0)
+    # vid-split fails without split times, -n or -b.
+    job['args'] = ['in.mp4']
+    assert not batch.run_job(job, 1, 1)
@@ -0,0 +1,26 @@
+import importlib.util
+import os
+
+from conftest import ROOT
+
+spec = importlib.util.spec_from_file_location(
+    'bench', os.path.join(ROOT, 'benchmarks', 'bench.py'))
+bench = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bench)
+
+def result(wall_time, ok=True):
+    return {'wall_time' : wall_time, 'ok' : ok}
+
+def test_compare_threshold():
+    baseline = {'a' : result(10.0), 'b' : result(10.0)}
+    assert not bench.compare({'a' : result(10.5), 'b' : result(5.0)},
+                             baseline, 0.1)
+    assert bench.compare({'a' : result(11.5)}, baseline, 0.1)
+
+def test_compare_failed():
+    # A failed run is quick but isn't a speedup.
+    assert bench.compare({'a' : result(0.1, ok=False)},
+                         {'a' : result(10.0)}, 0.1)
+    # Without a good baseline, there's nothing to compare against.
+    assert not bench.compare({'a' : result(10.0)},
+                             {'a' : result(0.1, ok=False)}, 0.1)
@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+from vidutils import common
+
+class Process:
+    returncode = 0
+
+    def wait(self):
+        return self.returncode
+
+def test_run_process_stdin(monkeypatch):
+    calls = []
+    def popen(args, **kwargs):
+        calls.append(kwargs)
+        return Process()
+    monkeypatch.setattr(subprocess, 'Popen', popen)
+
+    assert common._run_process(['true', '-i', 'in.mp4', 'out.mp4']) == 0
+    assert calls[-1]['stdin'] == subprocess.DEVNULL
+    # Only a command reading stdin as an input gets it.
+    common._run_process(['true', '-i', 'pipe:0', 'out.mp4'])
+    assert 'stdin' not in calls[-1]
+
+def test_no_handlers_on_import():
+    # Only the tools' main() functions set up logging.
+    result = subprocess.run([sys.executable, '-c', 'import logging; '
+                             'import vidutils.batch, vidutils.edl, '
+                             'vidutils.merge, vidutils.split, vidutils.volume; '
+                             'print(len(logging.getLogger().handlers))'],
+                            stdout=subprocess.PIPE,
+                            env=dict(os.environ, PYTHONPATH=ROOT), check=True)
+    assert result.stdout == b'0\n'
+
+def test_tool_logs_once(tmp_path):
+    result = subprocess.run([sys.executable, '-m', 'vidutils.split',
+                             'in.mp4'], cwd=str(tmp_path),
+                            stderr=subprocess.PIPE,
+                            env=dict(os.environ, PYTHONPATH=ROOT))
+    assert result.stderr == b'Give exactly one of split times, -n or -b\n'
@@ -0,0 +1,69 @@
+import datetime
+
+import pytest
+
+from conftest import frame_hashes, make_clip, needs_ffmpeg
+from vidutils import edl, merge
+
+def seconds(value):
+    return datetime.timedelta(seconds=value)
+
+@pytest.fixture(scope='module')
+def source(tmp_path_factory):
+    '''A fifteen-second clip at 30 fps with keyframes every two seconds.'''
+
+    return make_clip(str(tmp_path_factory.mktemp('edl') / 'src.mp4'), 15)
+
+def test_add_clip_checks():
+    timeline = edl.Timeline()
+    with pytest.raises(ValueError):
+        timeline.add_clip('a.mp4', 5, 5)
+    with pytest.raises(ValueError):
+        timeline.add_clip('a.mp4', 0, 5, crossfade=1)
+    timeline.add_clip('a.mp4', 0, 5)
+    with pytest.raises(ValueError):
+        timeline.add_clip('b.mp4', 0, 10, crossfade=6)
+    timeline.add_clip('b.mp4', '00:00:01', '00:00:04', crossfade=1.5)
+    assert timeline.duration() == 6.5
+
+@needs_ffmpeg
+def test_compile_ranges(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    timeline = edl.Timeline()
+    timeline.add_clip(source, 0, 10)
+    timeline.add_clip(source, 5, 15, crossfade=1.5)
+    intermediates = merge.Intermediates()
+    try:
+        stages = timeline.compile(str(tmp_path / 'out.mp4'), intermediates)
+    finally:
+        intermediates.close()
+
+    # The copies are snapped to the keyframes at 8s in each clip's source
+    # time, and the crossfade renders everything between them.
+    first, crossfade, second = stages['concat'][0].args[0]
+    assert first[:2] == (source, None)
+    assert first[2] < seconds(8)
+    assert first[3] == seconds(8)
+    assert second == (source, seconds(8.001), None)
+
+    ffmpeg_args = stages['crossfade_videos/0'][0].args[0]
+    inputs = [i for i, arg in enumerate(ffmpeg_args) if arg == '-ss']
+    assert [ffmpeg_args[i + 1] for i in inputs] == ['7.999', '5.0']
+    assert [ffmpeg_args[i + 3] for i in inputs] == ['2.001', '2.999']
+
+@needs_ffmpeg
+def test_render_frames(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    timeline = edl.Timeline()
+    timeline.add_clip(source, 0, 10)
+    timeline.add_clip(source, 5, 15, crossfade=1.5)
+    out = str(tmp_path / 'out.mp4')
+    timeline.render(out)
+
+    # 18.5 seconds: 240 copied frames up to the keyframe at 8s, the
+    # 105-frame crossfade, and 210 copied frames from 8s of the second clip.
+    hashes = frame_hashes(out)
+    source_hashes = frame_hashes(source)
+    assert len(hashes) == 555
+    assert hashes[:240] == source_hashes[:240]
+    assert hashes[345:] == source_hashes[240:450]
@@ -0,0 +1,72 @@
+import datetime
+
+import pytest
+
+from conftest import frame_hashes, needs_ffmpeg, run_tool
+from vidutils import merge
+
+def seconds(value):
+    return datetime.timedelta(seconds=value)
+
+KEYFRAMES = [0.0, 2.0, 4.0, 6.0, 8.0]
+
+def test_snap_times_at_end():
+    times = merge.crossfade_times('00:00:10', '00:00:05', True)
+    main_begin, main_end, crossfade_begin, crossfade_end = merge.snap_times(
+        times, KEYFRAMES, True, '00:00:10')
+    assert main_begin == seconds(0)
+    assert main_end == crossfade_begin == seconds(3.999)
+    assert crossfade_end == seconds(10)
+
+def test_snap_times_at_start():
+    times = merge.crossfade_times('00:00:10', '00:00:05', False)
+    main_begin, main_end, crossfade_begin, crossfade_end = merge.snap_times(
+        times, KEYFRAMES, False, '00:00:10')
+    assert main_begin == seconds(6.001)
+    assert main_end == seconds(10)
+    assert crossfade_begin == seconds(0)
+    assert crossfade_end == seconds(5.999)
+
+def test_snap_times_no_keyframe_after():
+    times = merge.crossfade_times('00:00:10', '00:00:09', False)
+    assert merge.snap_times(times, KEYFRAMES, False, '00:00:10') == (
+        seconds(10), seconds(10), seconds(0), seconds(10))
+
+def test_copy_args_frames():
+    args = merge.copy_args('in.mp4', seconds(6.001), seconds(10), 'out.mp4',
+                           120)
+    assert args[args.index('-ss') + 1] == '6.001'
+    assert args[args.index('-frames:v') + 1] == '120'
+    assert '-frames:v' not in merge.copy_args('in.mp4', seconds(0),
+                                              seconds(10), 'out.mp4')
+
+@needs_ffmpeg
+def test_copy_bounds(clips):
+    frames, outpoint, keyframe = merge.copy_bounds(clips[0], seconds(0),
+                                                   seconds(3.999))
+    assert frames == 120
+    assert keyframe == seconds(4)
+    # B-frames delay decoding, so the keyframe is decoded before it's shown.
+    assert outpoint < keyframe
+
+    frames, outpoint, keyframe = merge.copy_bounds(clips[0], seconds(2.001),
+                                                   seconds(5.999))
+    assert frames == 120
+    assert keyframe == seconds(6)
+
+    assert merge.copy_bounds(clips[0], seconds(8.001), seconds(10)) == (
+        None, None, None)
+
+@needs_ffmpeg
+@pytest.mark.parametrize('options', [['-a'], ['-a', '-z'], ['-a', '-c', '3']])
+def test_merge_accurate_frames(clips, tmp_path, options):
+    out = str(tmp_path / 'out.mp4')
+    run_tool('merge', options + ['-o', out] + clips, tmp_path)
+
+    # The clips are 300 frames each with a 150-frame crossfade. The main parts
+    # are copied up to the keyframe at 4s of the first clip and from the
+    # keyframe at 6s of the second.
+    hashes = frame_hashes(out)
+    assert len(hashes) == 450
+    assert hashes[:120] == frame_hashes(clips[0])[:120]
+    assert hashes[330:] == frame_hashes(clips[1])[180:]
@@ -0,0 +1,62 @@
+import json
+import re
+import subprocess
+
+import pytest
+
+from conftest import make_clip, needs_ffmpeg
+from vidutils import mp4
+
+pytestmark = needs_ffmpeg
+
+# Fields compared exactly with ffprobe, and those compared as numbers.
+FIELDS = ['codec_type', 'codec_name', 'width', 'height', 'pix_fmt', 'profile',
+          'level', 'time_base', 'avg_frame_rate', 'r_frame_rate',
+          'sample_rate', 'channels', 'nb_frames']
+NUMBERS = ['duration', 'bit_rate']
+
+@pytest.fixture(scope='module', params=['aac', 'libmp3lame'])
+def clip(request, tmp_path_factory):
+    return make_clip(str(tmp_path_factory.mktemp('mp4') / 'clip.mp4'), 5,
+                     audio_codec=request.param)
+
+def ffprobe(filename):
+    result = subprocess.run(['ffprobe', '-v', 'error', '-of', 'json',
+                             '-show_streams', '-show_format', filename],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode:
+        pytest.skip("ffprobe can't show streams")
+    return json.loads(result.stdout.decode('utf-8'))
+
+def test_read_matches_ffprobe(clip):
+    data = mp4.read(clip)[0]
+    expected = ffprobe(clip)
+    assert len(data['streams']) == len(expected['streams'])
+    for stream, probed in zip(data['streams'], expected['streams']):
+        for field in FIELDS:
+            if field in stream:
+                assert stream[field] == probed[field], field
+        for field in NUMBERS:
+            if field in stream and field in probed:
+                assert float(stream[field]) == pytest.approx(
+                    float(probed[field]), rel=0.01), field
+    for field in ['duration', 'start_time']:
+        assert float(data['format'][field]) == pytest.approx(
+            float(expected['format'][field]), abs=0.001)
+
+def test_keyframes_match_ffmpeg(clip):
+    # Decode only the keyframes, and have ffmpeg print their times.
+    result = subprocess.run(['ffmpeg', '-skip_frame', 'nokey', '-i', clip,
+                             '-map', '0:v', '-vf', 'showinfo', '-f', 'null',
+                             '-'], stderr=subprocess.PIPE, check=True)
+    times = [float(t) * 1000 for t in re.findall(
+        r'pts_time:([0-9.]+)', result.stderr.decode('utf-8'))]
+    data, keyframes = mp4.read(clip)
+    start = float(data['format']['start_time']) * 1000
+    assert keyframes == pytest.approx([t - start for t in times], abs=1)
+
+def test_not_mp4(tmp_path):
+    path = tmp_path / 'clip.txt'
+    path.write_bytes(b'not an mp4 file' * 10)
+    with pytest.raises(mp4.Unsupported):
+        mp4.read(str(path))
@@ -0,0 +1,50 @@
+import datetime
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT, make_clip, needs_ffmpeg, run_tool
+from vidutils import split
+
+def seconds(value):
+    return datetime.timedelta(seconds=value)
+
+def test_interval_times():
+    assert split.interval_times(seconds(10), seconds(3)) == [
+        seconds(3), seconds(6), seconds(9)]
+    # A split at the very end would make an empty part.
+    assert split.interval_times(seconds(9), seconds(3)) == [
+        seconds(3), seconds(6)]
+    assert split.interval_times(seconds(2), seconds(3)) == []
+
+def test_interval_times_trimmed():
+    assert split.interval_times(seconds(60), seconds(10), seconds(5),
+                                seconds(30)) == [seconds(15), seconds(25)]
+
+@pytest.mark.parametrize('interval', [0, -1])
+def test_interval_times_not_positive(interval):
+    with pytest.raises(ValueError):
+        split.interval_times(seconds(10), seconds(interval))
+
+def test_part_bounds():
+    assert split.part_bounds([seconds(6), seconds(3)], seconds(1)) == [
+        (seconds(1), seconds(3)), (seconds(3), seconds(6)),
+        (seconds(6), None)]
+
+@pytest.mark.parametrize('options', [[], ['-n', '0'], ['-b', '-5'],
+                                     ['-n', '1', '00:00:03']])
+def test_bad_schedule(tmp_path, options):
+    result = subprocess.run([sys.executable, '-m', 'vidutils.split',
+                             'in.mp4'] + options, cwd=str(tmp_path),
+                            env=dict(os.environ, PYTHONPATH=ROOT))
+    assert result.returncode != 0
+
+@needs_ffmpeg
+def test_split_times_after_options(tmp_path):
+    make_clip(str(tmp_path / 'in.mp4'), 8)
+    run_tool('split', ['in.mp4', '-p', 'part', '00:00:02.67', '00:00:05.33'],
+             tmp_path)
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'in.mp4', 'part1.mp4', 'part2.mp4', 'part3.mp4']
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT, make_clip, needs_ffmpeg, run_tool
+from vidutils import common, volume
+
+def test_parse_segment():
+    assert volume.parse_segment('00:00:01-00:00:02.5') == (1.0, 2.5)
+    assert volume.parse_segment((1, 2)) == (1, 2)
+
+def test_parse_volume():
+    assert volume.parse_volume('0.5') == 0.5
+    assert volume.parse_volume('-6dB') == pytest.approx(0.501, abs=0.001)
+    assert volume.parse_volume('1/3') == '1/3'
+    with pytest.raises(ValueError):
+        volume.parse_volume('1,2')
+
+def test_normalize_segments_sorted():
+    assert volume.normalize_segments(['00:00:05-00:00:06', (1, 2)],
+                                     ['0', '0.5']) == [(1, 2, 0.5),
+                                                       (5.0, 6.0, 0.0)]
+
+def test_normalize_segments_last_wins():
+    assert volume.normalize_segments([(0, 10), (2, 4)], ['0', '2']) == [
+        (0, 2, 0.0), (2, 4, 2.0), (4, 10, 0.0)]
+    # A later segment hides an earlier one that ends inside it.
+    assert volume.normalize_segments([(2, 4), (0, 10)], ['2', '0']) == [
+        (0, 10, 0.0)]
+
+def test_normalize_segments_merges_adjacent():
+    assert volume.normalize_segments([(0, 1), (1, 2), (2, 3)],
+                                     ['0', '0', '0.5']) == [(0, 2, 0.0),
+                                                           (2, 3, 0.5)]
+
+def test_normalize_segments_skips_empty():
+    assert volume.normalize_segments([(3, 3), (4, 2)], ['0', '0']) == []
+
+def test_edit_volumes_ungrouped_rules():
+    rules = {1 : [('00:00:01-00:00:02', '0')], 3 : [((1, 2), '0.5')]}
+    with pytest.raises(ValueError, match='Channel 3'):
+        volume.edit_volumes('in.mp4', 3, 'out.mp4', rules, [[1, 2]])
+
+def test_no_segments(tmp_path):
+    result = subprocess.run([sys.executable, '-m', 'vidutils.volume', '-n',
+                             '1', '-', '-o', 'out.mp4'], cwd=str(tmp_path),
+                            env=dict(os.environ, PYTHONPATH=ROOT))
+    assert result.returncode != 0
+
+@needs_ffmpeg
+def test_segments_after_options(tmp_path):
+    make_clip(str(tmp_path / 'in.mp4'), 4)
+    run_tool('volume', ['in.mp4', '-o', 'out.mp4', '-c', '1',
+                        '00:00:01-00:00:03'], tmp_path)
+    assert os.path.exists(str(tmp_path / 'out.mp4'))
+
+@needs_ffmpeg
+@pytest.mark.parametrize('audio_codec', ['aac', 'libmp3lame'])
+def test_splice_packets(tmp_path, audio_codec):
+    make_clip(str(tmp_path / 'in.mp4'), 6, audio_codec=audio_codec)
+    run_tool('volume', ['in.mp4', '00:00:01-00:00:03', '-o', 'out.mp4', '-S'],
+             tmp_path)
+    # The encoder is picked by codec, as mp3 has no encoder named "mp3".
+    assert len(common.probe_packets(str(tmp_path / 'out.mp4'), 'a:0')) == len(
+        common.probe_packets(str(tmp_path / 'in.mp4'), 'a:0'))
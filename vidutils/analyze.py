@@ -0,0 +1,168 @@
+'''Analyze the audio and video of a file with NumPy to find where to edit it.
+NumPy is an optional dependency, needed only for these functions.'''
+
+import logging
+import subprocess
+import sys
+
+from . import common
+
+_log = logging.getLogger(__name__)
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        _log.error('NumPy is needed for analysis, install vidutils[analysis]')
+        sys.exit(1)
+    return numpy
+
+def hysteresis_state(np, above, below, state):
+    '''Return an array with the hysteresis state for each element of the
+    boolean arrays *above* and *below*: True after an element that's above,
+    until one that's below. *state* is the state before the first element.'''
+
+    events = np.full(len(above), -1, dtype=np.int8)
+    events[below] = 0
+    events[above] = 1
+    # Carry the index of the last event forward to each element.
+    last = np.where(events >= 0, np.arange(len(events)), -1)
+    np.maximum.accumulate(last, out=last)
+    return np.where(last >= 0, events[np.maximum(last, 0)] == 1, state)
+
+def loudness_segments(filename, channel, threshold, hysteresis=3.0,
+                      min_duration=1.0, window=0.4, rate=16000,
+                      chunk_windows=1024):
+    '''Return a list of (start, stop) pairs in seconds for the parts of audio
+    *channel* (numbered from 1) of *filename* louder than *threshold* dBFS.
+    Loudness is the RMS level of each *window* seconds of audio, downmixed
+    and resampled to *rate*. A segment starts when a window reaches the
+    threshold and ends when one drops *hysteresis* dB below it, and segments
+    shorter than *min_duration* seconds are dropped. The audio is streamed
+    from ffmpeg in chunks of *chunk_windows* windows, so memory use doesn't
+    grow with the length of the file.'''
+
+    np = _import_numpy()
+    window_samples = int(window * rate)
+    ffmpeg_args = ['ffmpeg', '-v', 'error', '-i', filename, '-map',
+                   '0:a:{}'.format(channel - 1), '-ac', '1', '-ar', str(rate),
+                   '-f', 'f32le', '-']
+    _log.info('Analyzing loudness: %s', ' '.join(ffmpeg_args))
+    proc = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE,
+                            stdin=subprocess.DEVNULL)
+
+    segments = []
+    state = False
+    start = None
+    position = 0
+    leftover = np.zeros(0, dtype=np.float32)
+    chunk_bytes = window_samples * chunk_windows * 4
+    while True:
+        data = proc.stdout.read(chunk_bytes)
+        samples = np.concatenate([leftover,
+                                  np.frombuffer(data, dtype=np.float32)])
+        num_windows = len(samples) // window_samples
+        if not data and not num_windows:
+            break
+        leftover = samples[num_windows * window_samples:]
+        frames = samples[:num_windows * window_samples].reshape(
+            num_windows, window_samples)
+
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+        level = 20 * np.log10(np.maximum(rms, 1e-10))
+        states = hysteresis_state(np, level >= threshold,
+                                  level < threshold - hysteresis, state)
+
+        # Find where the state changes, including from the previous chunk.
+        changes = np.flatnonzero(np.diff(np.concatenate([[state], states])
+                                         .astype(np.int8)))
+        for i in changes:
+            time = (position + int(i)) * window
+            if states[i]:
+                start = time
+            else:
+                segments.append((start, time))
+        if len(states):
+            state = bool(states[-1])
+        position += num_windows
+        if not data:
+            break
+
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, ffmpeg_args)
+    if state:
+        segments.append((start, position * window))
+
+    segments = [(a, b) for a, b in segments if b - a >= min_duration]
+    _log.info('Found %d segment(s) louder than %s dBFS', len(segments),
+              threshold)
+    return segments
+
+def cut_scores(filename, begin, end, fps, width=64, height=36,
+               chunk_frames=256):
+    '''Return arrays (times, scores, levels) for the video frames of
+    *filename* between *begin* and *end* seconds, where *fps* is the video's
+    frame rate. Each score is the mean absolute difference from the previous
+    frame of a downscaled grayscale copy, from 0 to 1, and each level is the
+    frame's mean brightness, from 0 to 1. Frames are streamed from ffmpeg in
+    chunks of *chunk_frames*.'''
+
+    np = _import_numpy()
+    ffmpeg_args = ['ffmpeg', '-v', 'error', '-ss', str(begin), '-i', filename,
+                   '-t', str(end - begin), '-map', '0:v:0', '-vf',
+                   'scale={}:{},format=gray'.format(width, height), '-f',
+                   'rawvideo', '-']
+    _log.info('Analyzing frames: %s', ' '.join(ffmpeg_args))
+    proc = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE,
+                            stdin=subprocess.DEVNULL)
+
+    frame_bytes = width * height
+    scores = []
+    levels = []
+    previous = None
+    while True:
+        data = proc.stdout.read(frame_bytes * chunk_frames)
+        num_frames = len(data) // frame_bytes
+        if not num_frames:
+            break
+        frames = np.frombuffer(data[:num_frames * frame_bytes],
+                dtype=np.uint8).reshape(num_frames, -1).astype(np.int16)
+        if previous is None:
+            previous = frames[:1]
+        diffs = np.abs(np.diff(np.concatenate([previous, frames]), axis=0))
+        scores.append(diffs.mean(axis=1) / 255)
+        levels.append(frames.mean(axis=1) / 255)
+        previous = frames[-1:]
+
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, ffmpeg_args)
+    scores = np.concatenate(scores) if scores else np.zeros(0)
+    levels = np.concatenate(levels) if levels else np.zeros(0)
+    return (begin + np.arange(len(scores)) / fps, scores, levels)
+
+def snap_to_cut(filename, time, tolerance, fps, min_score=0.1,
+                black_level=0.08):
+    '''Return the best place to cut the video in *filename* within
+    *tolerance* seconds of *time*, or *time* itself if nothing stands out.
+    The black frame nearest *time* is preferred, followed by the scene change
+    with the largest score of at least *min_score* from `cut_scores()`.
+    Results are cached for each file.'''
+
+    kind = 'cut-{:.3f}-{:.3f}'.format(time, tolerance)
+    cached = common.cache_get(filename, kind)
+    if cached is not None:
+        return cached
+
+    np = _import_numpy()
+    begin = max(time - tolerance, 0)
+    times, scores, levels = cut_scores(filename, begin, time + tolerance, fps)
+    snapped = time
+    black = np.flatnonzero(levels < black_level)
+    if len(black):
+        snapped = float(times[black[np.argmin(np.abs(times[black] - time))]])
+    elif len(scores) and scores.max() >= min_score:
+        snapped = float(times[np.argmax(scores)])
+
+    _log.info('Snapped cut at %.2fs to %.2fs', time, snapped)
+    common.cache_put(filename, kind, snapped)
+    return snapped
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+'''Run a manifest of vid-split, vid-volume and vid-merge jobs, running
+independent jobs at once while keeping within the machine's cores and free
+disk space.'''
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+
+from . import common
+
+_log = logging.getLogger(__name__)
+
+TOOLS = ['split', 'volume', 'merge']
+
+def read_manifest(filename):
+    '''Read the job manifest in *filename*, a JSON file or a YAML file if the
+    name ends in .yaml or .yml, and return its list of jobs. Each job is a dict
+    with a unique 'name', a 'tool' (one of `TOOLS`) and the tool's command line
+    'args'. The optional 'after' list names jobs that must finish first, and
+    the optional 'inputs' and 'outputs' lists name the job's files.'''
+
+    with open(filename, encoding='utf-8') as f:
+        if filename.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                _log.error('PyYAML is needed to read YAML manifests')
+                sys.exit(1)
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    jobs = manifest['jobs'] if isinstance(manifest, dict) else manifest
+    names = set()
+    for job in jobs:
+        if job.get('name') in names or 'name' not in job:
+            _log.error('Each job needs a unique name: %s', job)
+            sys.exit(1)
+        names.add(job['name'])
+        if job.get('tool') not in TOOLS:
+            _log.error('Job %s has unknown tool %s', job['name'],
+                       job.get('tool'))
+            sys.exit(1)
+        for key in ['args', 'after', 'inputs', 'outputs']:
+            job.setdefault(key, [])
+
+    for job in jobs:
+        for name in job['after']:
+            if name not in names:
+                _log.error('Job %s waits for unknown job %s', job['name'], name)
+                sys.exit(1)
+    return jobs
+
+def read_state(filename):
+    '''Return the set of job names recorded as completed in the state file
+    *filename*.'''
+
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return set(json.load(f)['completed'])
+    except (OSError, ValueError, KeyError):
+        return set()
+
+def write_state(filename, completed):
+    '''Record the job names in *completed* in the state file *filename*.'''
+
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'completed' : sorted(completed)}, f)
+    os.replace(filename + '.tmp', filename)
+
+def estimate_space(job):
+    '''Return an estimate in bytes of the disk space *job* will write, assuming
+    its outputs are about as large as its inputs.'''
+
+    return sum(os.path.getsize(f) for f in job['inputs'] if os.path.exists(f))
+
+def free_space(path):
+    '''Return the free disk space in bytes where *path* will be written, on
+    the nearest of its parent directories that already exists.'''
+
+    directory = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return shutil.disk_usage(directory).free
+
+def run_job(job, threads, retries):
+    '''Run the tool for *job* in a separate process, limiting each of its
+    ffmpeg processes to *threads* threads and trying up to *retries* more times
+    if it fails. Returns True if the job succeeded.'''
+
+    args = [sys.executable, '-m', 'vidutils.' + job['tool']] + job['args']
+    env = dict(os.environ, VIDUTILS_THREADS=str(threads))
+    for attempt in range(retries + 1):
+        if attempt:
+            _log.info('Retrying job %s (attempt %d)', job['name'], attempt + 1)
+        _log.info('Starting job %s: %s', job['name'], ' '.join(args))
+        result = subprocess.run(args, env=env, stdin=subprocess.DEVNULL)
+        if result.returncode == 0:
+            return True
+    _log.error('Job %s failed', job['name'])
+    return False
+
+def run_jobs(jobs, state_file, num_jobs=None, threads=None, retries=0,
+             force=False):
+    '''Run *jobs* from `read_manifest()` in dependency order, with at most
+    *num_jobs* jobs at once and *threads* threads for each ffmpeg process. By
+    default these are sized to the number of cores. A job only starts when
+    the estimated space it writes fits in the free disk space not already
+    claimed by running jobs. Jobs recorded as completed in *state_file* whose
+    outputs exist are skipped unless *force* is True. Returns the set of names
+    of jobs that failed or couldn't run.'''
+
+    cores = os.cpu_count() or 1
+    if not num_jobs:
+        num_jobs = max(1, cores // 4)
+    if not threads:
+        threads = max(1, cores // num_jobs)
+
+    completed = set() if force else read_state(state_file)
+    done = set()
+    for job in jobs:
+        if job['name'] in completed and all(os.path.exists(f)
+                                            for f in job['outputs']):
+            _log.info('Skipping completed job %s', job['name'])
+            done.add(job['name'])
+    completed &= done
+
+    # Probe the inputs that already exist, so the results are cached for
+    # every job that uses them. A job with an input that can't be probed
+    # fails without stopping the others.
+    failed = set()
+    for job in jobs:
+        if job['name'] in done:
+            continue
+        for f in job['inputs']:
+            if not os.path.exists(f):
+                continue
+            try:
+                common.probe_data(f)
+            except (subprocess.CalledProcessError, OSError, ValueError) as e:
+                _log.error('Unable to probe input %s of job %s: %s', f,
+                           job['name'], e)
+                failed.add(job['name'])
+                break
+
+    pending = [j for j in jobs if j['name'] not in done | failed]
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(num_jobs) as executor:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= num_jobs:
+                    break
+                if any(n in failed for n in job['after']):
+                    _log.error('Not running job %s since a job it waits for '
+                               'failed', job['name'])
+                    failed.add(job['name'])
+                    pending.remove(job)
+                    continue
+                if not all(n in done for n in job['after']):
+                    continue
+
+                space = estimate_space(job)
+                claimed = sum(s for j, s in running.values())
+                out_file = job['outputs'][0] if job['outputs'] else '.'
+                if space + claimed > free_space(out_file):
+                    if running:
+                        continue
+                    _log.error('Not enough free disk space for job %s',
+                               job['name'])
+                    failed.add(job['name'])
+                    pending.remove(job)
+                    continue
+
+                pending.remove(job)
+                future = executor.submit(run_job, job, threads, retries)
+                running[future] = (job, space)
+
+            if not running:
+                # Whatever is left waits on jobs that can never finish.
+                for job in pending:
+                    _log.error('Job %s can never run', job['name'])
+                    failed.add(job['name'])
+                break
+
+            finished, _ = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                job, space = running.pop(future)
+                if future.result():
+                    done.add(job['name'])
+                    completed.add(job['name'])
+                    write_state(state_file, completed)
+                else:
+                    failed.add(job['name'])
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('manifest', nargs=1, metavar='<filename>',
+                        help='A JSON or YAML manifest of jobs to run')
+    parser.add_argument('-j', dest='jobs', metavar='N', type=int, default=None,
+            help='Run up to N jobs at once (default: a quarter of the cores)')
+    parser.add_argument('-t', dest='threads', metavar='N', type=int,
+            default=None, help='Threads for each ffmpeg process (default: the '
+            'cores divided by the number of jobs)')
+    parser.add_argument('-r', dest='retries', metavar='N', type=int, default=0,
+            help='Retry failed jobs up to N times')
+    parser.add_argument('-f', dest='force', action='store_true', default=False,
+            help='Run all jobs, even those completed in an earlier run')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    manifest = args.manifest[0]
+    jobs = read_manifest(manifest)
+    failed = run_jobs(jobs, manifest + '.state', args.jobs, args.threads,
+                      args.retries, args.force)
+    if failed:
+        _log.error('%d job(s) failed: %s', len(failed),
+                   ', '.join(sorted(failed)))
+        sys.exit(1)
+    _log.info('All %d job(s) completed', len(jobs))
+
+if __name__ == '__main__':
+    main()
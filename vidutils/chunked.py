@@ -0,0 +1,91 @@
+'''Encode a long render in chunks that run in parallel, split at GOP
+boundaries so each chunk starts with a keyframe, and stitch the chunks back
+together with the concat demuxer without re-encoding them.'''
+
+import logging
+import math
+import os
+
+from . import common
+
+_log = logging.getLogger(__name__)
+
+class LocalBackend:
+    '''Run chunk commands as local ffmpeg processes, up to *jobs* at once,
+    each with *threads* threads, defaulting to an even share of the cores.
+    Another backend, such as one sending commands to other hosts, only needs
+    a `run()` method taking the same arguments.'''
+
+    def __init__(self, jobs=None, threads=None):
+        self.jobs = jobs if jobs else os.cpu_count() or 1
+        self.threads = threads
+
+    def run(self, commands, stage=None):
+        '''Run each ffmpeg command in *commands*, whose last argument is the
+        file it writes, raising `subprocess.CalledProcessError` if any of them
+        fail. Telemetry for the commands is tagged with *stage*.'''
+
+        threads = self.threads
+        if not threads:
+            threads = max(1, (os.cpu_count() or 1) // self.jobs)
+        commands = [c if '-threads' in c else
+                    c[:-1] + ['-threads', str(threads), c[-1]]
+                    for c in commands]
+        common.run_parallel(commands, self.jobs, stage)
+
+def chunk_bounds(duration, fps, gop, chunks):
+    '''Return a list of (begin, end, frames) tuples splitting a render of
+    *duration* seconds at *fps* into at most *chunks* chunks, with begin and
+    end in seconds. Each chunk but the last is a whole number of GOPs of
+    *gop* frames long, so keyframes fall at the same frames as in a single
+    encode.'''
+
+    total = int(round(duration * fps))
+    chunk_frames = max(1, math.ceil(total / max(chunks, 1) / gop)) * gop
+    bounds = []
+    for first in range(0, total, chunk_frames):
+        frames = min(chunk_frames, total - first)
+        bounds.append((round(first / fps, 6),
+                       round((first + frames) / fps, 6), frames))
+    return bounds
+
+def render_chunked(chunk_args, audio_args, bounds, out_filename, backend,
+                   delete_temp=True, stage='chunked'):
+    '''Render the video of each chunk in *bounds*, from `chunk_bounds()`, and
+    any audio with *backend*, then stitch them into *out_filename*.
+    *chunk_args* is called with the begin, end and frames of a chunk and the
+    file to write, and returns the ffmpeg arguments rendering only the video of
+    that chunk. *audio_args* is called with the file to write and returns the
+    ffmpeg arguments rendering all of the audio in one piece, or is None if
+    there's no audio. Telemetry is tagged with *stage*.'''
+
+    fhs = []
+    commands = []
+    for begin, end, frames in bounds:
+        fh = common.make_temp_file(out_filename, 'chunk', delete=delete_temp)
+        fhs.append(fh)
+        commands.append(chunk_args(begin, end, frames, fh.name))
+    audio_fh = None
+    if audio_args:
+        # Audio is cheap to encode, and audio frames don't line up with the
+        # chunks, so it's rendered in one piece alongside them.
+        audio_fh = common.make_temp_file(out_filename, 'audio',
+                                         suffix='.m4a', delete=delete_temp)
+        commands.append(audio_args(audio_fh.name))
+    _log.info('Rendering %s in %d chunk(s)', out_filename, len(bounds))
+
+    try:
+        backend.run(commands, stage + '/chunks')
+        list_file = common.write_concat_list([fh.name for fh in fhs])
+        ffmpeg_args = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i',
+                       list_file]
+        if audio_fh:
+            ffmpeg_args += ['-i', audio_fh.name, '-map', '0:v', '-map', '1:a']
+        ffmpeg_args += ['-c', 'copy', '-y', out_filename]
+        try:
+            common.run_command(ffmpeg_args, stage + '/stitch')
+        finally:
+            os.remove(list_file)
+    finally:
+        for fh in fhs + ([audio_fh] if audio_fh else []):
+            fh.close()
@@ -1,61 +1,700 @@
+import concurrent.futures
 import datetime
+import hashlib
+import json
 import logging
-import re
+import os
+import os.path
+import shlex
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-_log = logging.getLogger()
-_log.setLevel(logging.INFO)
-_log.addHandler(logging.StreamHandler())
+from . import mp4
 
-def run_command(args):
-    '''Run command with args and check that we didn't error'''
+_log = logging.getLogger(__name__)
+
+# Directory of persistent cached data, such as ffprobe results, and the size in
+# bytes beyond which the least recently used entries are evicted.
+CACHE_DIR = os.environ.get('VIDUTILS_CACHE_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'vidutils'))
+CACHE_SIZE = int(os.environ.get('VIDUTILS_CACHE_SIZE', 64 * 1024 * 1024))
+
+_cache_memo = {}
+
+# Encoders to use for the codecs ffprobe reports, where the names differ.
+VIDEO_ENCODERS = {'h264' : 'libx264', 'hevc' : 'libx265', 'vp9' : 'libvpx-vp9',
+                  'av1' : 'libaom-av1'}
+AUDIO_ENCODERS = {'mp3' : 'libmp3lame', 'opus' : 'libopus',
+                  'vorbis' : 'libvorbis'}
+
+# Encoder profile names for the profiles ffprobe reports. Profiles not listed,
+# like intra-only profiles and HEVC's "Rext", which covers several encoder
+# profiles, are left to the encoder to choose.
+ENCODER_PROFILES = {
+    'libx264' : {'Constrained Baseline' : 'baseline', 'Baseline' : 'baseline',
+                 'Main' : 'main', 'High' : 'high', 'High 10' : 'high10',
+                 'High 4:2:2' : 'high422', 'High 4:4:4 Predictive' : 'high444'},
+    'libx265' : {'Main' : 'main', 'Main 10' : 'main10',
+                 'Main Still Picture' : 'mainstillpicture'},
+}
+
+# Named speed/quality trade-offs, giving the encoder preset for each encoder
+# that has them.
+ENCODE_PRESETS = {
+    'fast' : {'libx264' : 'veryfast', 'libx265' : 'veryfast'},
+    'balanced' : {'libx264' : 'medium', 'libx265' : 'medium'},
+    'quality' : {'libx264' : 'slow', 'libx265' : 'slow'},
+}
+
+# Output formats that can be read while they're written, for pipes that
+# ffmpeg can't seek back into to finish the file.
+STREAM_FORMATS = {
+    'mp4' : ['-f', 'mp4', '-movflags',
+             'frag_keyframe+empty_moov+default_base_moof'],
+    'ts' : ['-f', 'mpegts'],
+}
+
+# Tool name and hooks for telemetry from run_command() and run_parallel().
+_tool = None
+_progress_hooks = []
+_metrics_lock = threading.Lock()
+
+# Running processes, so run_stages() can stop them when a stage fails.
+_active_procs = set()
+_active_lock = threading.Lock()
+_cancelled = threading.Event()
+
+def parse_time(time):
+    '''Parse a time in HH:MM:SS[.SSS] format into a `datetime.timedelta`
+    object'''
+    args = dict(zip(['hours', 'minutes', 'seconds'],
+        [float(x) for x in time.split(':')]))
+    return datetime.timedelta(**args)
+
+def delta_to_str(delta):
+    '''Concert a datetime.timedelta into a valid timestamp string for ffmpeg.'''
+    total_sec = delta.total_seconds()
+    hours, remainder = divmod(total_sec, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return '{:02.0f}:{:02.0f}:{:05.2f}'.format(hours, minutes, seconds)
+
+def make_temp_file(filename=None, desc=None, **kwargs):
+    prefix = ''
+    if filename:
+        prefix = os.path.basename(filename) + '-'
+    if desc:
+        prefix += desc + '-'
+    if prefix:
+        kwargs['prefix'] = prefix
+    if 'dir' not in kwargs:
+        kwargs['dir'] = os.getcwd()
+    if 'suffix' not in kwargs:
+        kwargs['suffix'] = '.mp4'
+    return tempfile.NamedTemporaryFile(**kwargs)
+
+def write_concat_list(files):
+    '''Write a list file for ffmpeg's concat demuxer with the given *files*, in
+    order, and return its filename. An entry of *files* can also be a
+    (filename, inpoint, outpoint) tuple to use only the part of the file
+    between the `datetime.timedelta` objects *inpoint* and *outpoint*, either
+    of which can be None. A fourth item gives the duration of the part, when
+    it differs from the outpoint less the inpoint. The caller removes the list
+    file when done.'''
+
+    list_fh = make_temp_file(desc='vid-list', mode='w+', suffix='.txt',
+                             delete=False)
+    for f in files:
+        inpoint = outpoint = duration = None
+        if isinstance(f, tuple):
+            duration = f[3] if len(f) > 3 else None
+            f, inpoint, outpoint = f[:3]
+        list_fh.write("file '{}'\n".format(f.replace("'", "'\\''")))
+        if inpoint:
+            list_fh.write('inpoint {}\n'.format(inpoint.total_seconds()))
+        if outpoint:
+            list_fh.write('outpoint {}\n'.format(outpoint.total_seconds()))
+        if duration:
+            list_fh.write('duration {}\n'.format(duration.total_seconds()))
+    list_fh.close()
+    return list_fh.name
+
+def is_pipe(filename):
+    '''Return whether *filename* is "-", for stdin or stdout, or a FIFO.'''
+
+    if filename == '-':
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(filename).st_mode)
+    except OSError:
+        return False
+
+def input_url(filename):
+    '''Return the ffmpeg input for *filename*, reading stdin for "-".'''
+
+    return 'pipe:0' if filename == '-' else filename
+
+def output_args(filename, stream_format=None):
+    '''Return ffmpeg output arguments that write *filename*, or stdout for
+    "-". If *stream_format* names one of `STREAM_FORMATS`, the output is
+    written in that format so it can be read while it's written. Pipes are
+    always written that way, as fragmented MP4 unless *stream_format* is
+    given.'''
+
+    if not is_pipe(filename):
+        args = list(STREAM_FORMATS[stream_format]) if stream_format else []
+        return args + [filename]
+
+    args = list(STREAM_FORMATS[stream_format or 'mp4'])
+    if filename == '-':
+        return args + ['pipe:1']
+    # A FIFO already exists, so don't ask whether to overwrite it.
+    return args + ['-y', filename]
+
+def thread_args(args):
+    '''Return the command *args* with the ffmpeg thread count set from the
+    VIDUTILS_THREADS environment variable, if it's set and the command is an
+    ffmpeg command that doesn't already set one.'''
+
+    threads = os.environ.get('VIDUTILS_THREADS')
+    if not threads or args[0] != 'ffmpeg' or '-threads' in args:
+        return args
+    return args[:-1] + ['-threads', threads, args[-1]]
+
+def set_tool(name):
+    '''Set the tool name used to tag telemetry records.'''
+
+    global _tool
+    _tool = name
+
+def add_progress_hook(hook):
+    '''Call *hook* with each telemetry record from the ffmpeg commands we run.
+    Records are dicts with an 'event' of 'progress' for each progress update
+    from ffmpeg, or 'stage' once a command finishes, and the 'tool' and 'stage'
+    of the command. Progress records carry ffmpeg's 'frame', 'fps', 'speed',
+    'out_time' (in seconds) and 'bytes_out'. Stage records carry the
+    'wall_time' in seconds, the final 'fps' and 'speed', the 'bytes_in' of the
+    input files, counting the files in concat lists rather than the lists, the
+    'bytes_out' written and the 'returncode'. If the
+    VIDUTILS_METRICS environment variable names a file, records are also
+    appended to it as JSON lines.'''
+
+    _progress_hooks.append(hook)
+
+def _emit(record):
+    for hook in _progress_hooks:
+        hook(record)
+
+    metrics_file = os.environ.get('VIDUTILS_METRICS')
+    if metrics_file:
+        with _metrics_lock, open(metrics_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+def _parse_progress(values):
+    '''Convert a block of key/value pairs from ffmpeg's -progress output into
+    the fields of a progress record.'''
+
+    def number(key, suffix=''):
+        value = values.get(key, 'N/A').strip()
+        if suffix and value.endswith(suffix):
+            value = value[:-len(suffix)]
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    out_time = number('out_time_us')
+    return {'frame' : number('frame'), 'fps' : number('fps'),
+            'speed' : number('speed', 'x'),
+            'out_time' : out_time / 1e6 if out_time is not None else None,
+            'bytes_out' : number('total_size')}
+
+def _run_process(args, stage=None, on_start=None, **kwargs):
+    '''Run the command *args*, returning its exit code. For ffmpeg commands,
+    progress is read from a pipe given to ffmpeg's -progress option and sent
+    out as telemetry records tagged with *stage*. *on_start* is called with
+    the process object once it has started, and any other keyword arguments
+    are passed to `subprocess.Popen`. Unless the command reads stdin as an
+    input, its stdin is /dev/null, so ffmpeg doesn't take keypresses or piped
+    data meant for us.'''
+
+    if not any(a == '-i' and b in ('-', 'pipe:0', 'pipe:')
+               for a, b in zip(args, args[1:])):
+        kwargs.setdefault('stdin', subprocess.DEVNULL)
+    record = {'tool' : _tool, 'stage' : stage}
+    begin = time.monotonic()
+    last = {}
+    if args[0] != 'ffmpeg' or os.name != 'posix':
+        proc = _start_process(args, on_start, **kwargs)
+        returncode = proc.wait()
+    else:
+        read_fd, write_fd = os.pipe()
+        progress_args = [args[0], '-progress', 'pipe:{}'.format(write_fd)]
+        try:
+            proc = _start_process(progress_args + args[1:], on_start,
+                                  pass_fds=(write_fd,), **kwargs)
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+
+        values = {}
+        with os.fdopen(read_fd, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                key, _, value = line.strip().partition('=')
+                values[key] = value
+                # Keep earlier values, since a block may not repeat them all.
+                if key == 'progress':
+                    last = _parse_progress(values)
+                    _emit(dict(record, event='progress', **last))
+        returncode = proc.wait()
+    with _active_lock:
+        _active_procs.discard(proc)
+
+    inputs = _input_files(args)
+    bytes_out = last.get('bytes_out')
+    if bytes_out is None and os.path.isfile(args[-1]):
+        bytes_out = os.path.getsize(args[-1])
+    stage_record = dict(record, event='stage',
+            wall_time=time.monotonic() - begin, fps=last.get('fps'),
+            speed=last.get('speed'),
+            bytes_in=sum(os.path.getsize(f) for f in inputs
+                         if os.path.isfile(f)),
+            bytes_out=bytes_out, returncode=returncode)
+    _emit(stage_record)
+    if stage_record['speed'] is not None:
+        _log.info('Stage %s took %.1fs at %.2fx realtime', stage,
+                  stage_record['wall_time'], stage_record['speed'])
+    return returncode
+
+def _input_files(args):
+    '''Return the unique files the ffmpeg command *args* reads, with the
+    files listed in any concat demuxer list in place of the list itself.'''
+
+    files = []
+    input_format = None
+    for i, a in enumerate(args[:-1]):
+        if a == '-f':
+            input_format = args[i + 1]
+        elif a == '-i':
+            if input_format == 'concat':
+                files += _concat_list_files(args[i + 1])
+            else:
+                files.append(args[i + 1])
+            input_format = None
+    return list(dict.fromkeys(os.path.abspath(f) for f in files))
+
+def _concat_list_files(list_file):
+    # Relative paths in the list are relative to the list file.
+    files = []
+    try:
+        with open(list_file, encoding='utf-8') as f:
+            for line in f:
+                directive, _, value = line.strip().partition(' ')
+                if directive == 'file':
+                    files.append(os.path.join(os.path.dirname(list_file),
+                                              shlex.split(value)[0]))
+    except (OSError, ValueError, IndexError):
+        pass
+    return files
+
+def _start_process(args, on_start=None, **kwargs):
+    with _active_lock:
+        if _cancelled.is_set():
+            raise StageCancelled('Not running command after a failed stage')
+        proc = subprocess.Popen(args, **kwargs)
+        _active_procs.add(proc)
+    if on_start:
+        on_start(proc)
+    return proc
+
+class StageCancelled(Exception):
+    '''Raised for a command that isn't run since another stage failed.'''
+
+def run_stages(stages, jobs):
+    '''Run the stages in the dict *stages*, which maps each stage name to a
+    (function, dependencies) pair, where dependencies lists the names of
+    stages that must finish before the function is called. Up to *jobs*
+    stages run at once. If a stage raises an exception, no further stages
+    start, the processes of running stages are terminated and the exception
+    is raised once they've stopped. Returns a dict of the result of each
+    stage.'''
+
+    _cancelled.clear()
+    results = {}
+    pending = dict(stages)
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        while pending or running:
+            if not error:
+                for name, (func, deps) in list(pending.items()):
+                    if len(running) >= jobs:
+                        break
+                    if all(d in results for d in deps):
+                        del pending[name]
+                        running[executor.submit(func)] = name
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except BaseException as e:
+                    if error:
+                        continue
+                    _log.error('Stage %s failed, stopping other stages', name)
+                    error = e
+                    with _active_lock:
+                        _cancelled.set()
+                        for proc in _active_procs:
+                            if proc.poll() is None:
+                                proc.terminate()
+    _cancelled.clear()
+    if error:
+        raise error
+    if pending:
+        raise ValueError('Stages with missing dependencies: {}'.format(
+            ', '.join(sorted(pending))))
+    return results
+
+def run_command(args, stage=None):
+    '''Run command with args and check that we didn't error. Telemetry for the
+    command is tagged with *stage*.'''
+    args = thread_args(args)
     _log.info('Running command: %s', ' '.join(args))
-    result = subprocess.run(args)
-    result.check_returncode()
+    returncode = _run_process(args, stage)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args)
 
-def probe_video(filename):
-    '''Run ffprobe on the given file and parse out the video length, video
-    resolution, video bitrate (rounded to nearest 1000 kb/s), and video fps.'''
+def run_parallel(commands, jobs, stage=None, remove_failed=False):
+    '''Run each command in the list *commands*, with at most *jobs* of them
+    running at once. If any command fails, no further commands are started, the
+    running ones are terminated and `subprocess.CalledProcessError` is raised
+    for the first failure. If *remove_failed* is True, the output file, the
+    last argument, of each command that failed or was terminated is removed.
+    Telemetry for the commands is tagged with *stage*.'''
+
+    lock = threading.Lock()
+    procs = []
+    errors = []
+
+    def start(proc):
+        with lock:
+            procs.append(proc)
+            # Another command may have failed while this one started.
+            if errors:
+                proc.terminate()
+
+    def run(args):
+        args = thread_args(args)
+        with lock:
+            if errors:
+                return
+            _log.info('Running command: %s', ' '.join(args))
+
+        returncode = _run_process(args, stage, start)
+        if not returncode:
+            return
+        if remove_failed and os.path.isfile(args[-1]):
+            os.remove(args[-1])
+        with lock:
+            if not errors:
+                errors.append(subprocess.CalledProcessError(returncode, args))
+            for p in procs:
+                if p.poll() is None:
+                    p.terminate()
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        for future in [executor.submit(run, c) for c in commands]:
+            future.result()
+    if errors:
+        raise errors[0]
+
+def file_key(filename, kind):
+    '''Return a key identifying the current contents of *filename* for cached
+    data of the given *kind*, made from the file's path, size, mtime and inode.
+    Any change to the file gives a new key, so stale entries are never used.'''
+
+    st = os.stat(filename)
+    ident = '\0'.join([kind, os.path.abspath(filename), str(st.st_size),
+                       str(st.st_mtime_ns), str(st.st_ino)])
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+def cache_get(filename, kind):
+    '''Return the cached data of the given *kind* for *filename*, or None if
+    there isn't any. Entries are kept in memory after the first lookup.'''
+
+    key = file_key(filename, kind)
+    if key in _cache_memo:
+        return _cache_memo[key]
+
+    path = os.path.join(CACHE_DIR, key + '.json')
+    try:
+        with open(path, encoding='utf-8') as f:
+            value = json.load(f)
+        # Update the mtime so eviction drops the least recently used entries.
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    _cache_memo[key] = value
+    return value
+
+def cache_put(filename, kind, value):
+    '''Cache the JSON-serializable *value* of the given *kind* for *filename*,
+    evicting the least recently used entries if the cache directory grows
+    beyond `CACHE_SIZE` bytes.'''
+
+    key = file_key(filename, kind)
+    _cache_memo[key] = value
+    path = os.path.join(CACHE_DIR, key + '.json')
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=CACHE_DIR,
+                                         suffix='.tmp', delete=False) as f:
+            json.dump(value, f)
+        os.replace(f.name, path)
+        _evict_cache()
+    except OSError as e:
+        _log.warning('Unable to write cache file %s: %s', path, e)
+
+def _evict_cache():
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.json'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= CACHE_SIZE:
+            break
+        os.remove(path)
+        total -= size
+
+def probe_data(filename):
+    '''Return the stream and format data that ffprobe reports for *filename*
+    as a dict parsed from ffprobe's JSON output. MP4 and MOV files are read
+    directly with `mp4.read()`, which also caches their keyframes for
+    `probe_keyframes()`, and other files are probed with ffprobe. Results are
+    cached.'''
+
+    data = cache_get(filename, 'probe')
+    if data is not None:
+        return data
+
+    if not os.environ.get('VIDUTILS_FFPROBE'):
+        try:
+            data, keyframes = mp4.read(filename)
+        except (mp4.Unsupported, OSError) as e:
+            _log.debug('Using ffprobe for %s: %s', filename, e)
+        else:
+            cache_put(filename, 'keyframes', [k / 1000 for k in keyframes])
+            cache_put(filename, 'probe', data)
+            return data
 
     _log.info('Checking video file %s', filename)
-    result = subprocess.run(['ffprobe', filename], stderr=subprocess.PIPE)
+    result = subprocess.run(['ffprobe', '-v', 'error', '-of', 'json',
+                             '-show_streams', '-show_format', filename],
+                            stdout=subprocess.PIPE)
     result.check_returncode()
+    data = json.loads(result.stdout.decode('utf-8'))
+    cache_put(filename, 'probe', data)
+    return data
 
-    ffprobe_out = result.stderr.decode('utf-8')
-    match = re.search('Duration: *([^,]+),', ffprobe_out)
-    if not match:
-        _log.error("Can't find video duration in file %s\n%s", filename,
-                   ffprobe_out)
+def probe_keyframes(filename):
+    '''Return a sorted list of the keyframe times in seconds of the first video
+    stream in *filename*, relative to the start of the file, as read from the
+    sample tables of an MP4 file or from ffprobe's packet data. Results are
+    cached.'''
+
+    # Probing an MP4 file directly caches its keyframes along the way.
+    start_time = float(probe_data(filename)['format'].get('start_time', 0))
+    keyframes = cache_get(filename, 'keyframes')
+    if keyframes is not None:
+        return keyframes
+
+    _log.info('Indexing keyframes in %s', filename)
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'packet=pts_time,flags', '-of',
+                             'csv=print_section=0', filename],
+                            stdout=subprocess.PIPE)
+    result.check_returncode()
+
+    keyframes = []
+    for line in result.stdout.decode('utf-8').splitlines():
+        fields = line.split(',')
+        if len(fields) < 2 or fields[0] == 'N/A' or 'K' not in fields[1]:
+            continue
+        keyframes.append(float(fields[0]) - start_time)
+    keyframes.sort()
+    cache_put(filename, 'keyframes', keyframes)
+    return keyframes
+
+def probe_packets(filename, stream):
+    '''Return a list of the (pts, dts, duration) of the packets of *stream*,
+    an ffmpeg stream specifier such as "a:0", in *filename*, sorted by pts and
+    in units of the stream's time base, as reported by ffprobe. Packets
+    without a pts are skipped, and the dts is the pts where there's none.
+    Results are cached.'''
+
+    kind = 'packets-' + stream
+    packets = cache_get(filename, kind)
+    if packets is not None:
+        return [tuple(p) for p in packets]
+
+    _log.info('Indexing %s packets in %s', stream, filename)
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams',
+                             stream, '-show_entries', 'packet=pts,dts,duration',
+                             '-of', 'csv=print_section=0', filename],
+                            stdout=subprocess.PIPE)
+    result.check_returncode()
+
+    packets = []
+    for line in result.stdout.decode('utf-8').splitlines():
+        fields = line.split(',')
+        if len(fields) < 3 or fields[0] == 'N/A':
+            continue
+        pts = int(fields[0])
+        packets.append((pts, int(fields[1]) if fields[1] != 'N/A' else pts,
+                        int(fields[2]) if fields[2] != 'N/A' else 0))
+    packets.sort()
+    cache_put(filename, kind, packets)
+    return packets
+
+def gop_size(keyframes, fps):
+    '''Return the typical GOP size in frames from the sorted list of
+    *keyframes* times in seconds and the video *fps*, or None if there are too
+    few keyframes to tell.'''
+
+    intervals = sorted(b - a for a, b in zip(keyframes, keyframes[1:]))
+    if not intervals:
+        return None
+    return max(1, int(round(intervals[len(intervals) // 2] * fps)))
+
+def _encoder_level(codec, level):
+    # H.264 levels are reported as 10 times the level, and HEVC levels as 30
+    # times the level.
+    if level <= 0:
+        return None
+    if codec == 'h264':
+        return '{:.1f}'.format(level / 10)
+    if codec == 'hevc':
+        return '{:.1f}'.format(level / 30)
+    return None
+
+def encode_args(fields, preset=None, threads=None, gop=None):
+    '''Return ffmpeg output arguments that encode video and audio to match the
+    streams of the video whose `probe_video()` *fields* are given, so that the
+    encoded video can be concatenated with stream copies of the original. The
+    codec, profile, level, pixel format, frame rate, timebase and bitrate of
+    the video stream are matched, along with the codec, sample rate, channels
+    and bitrate of each audio stream. *preset* names one of `ENCODE_PRESETS`
+    to trade encoding speed for quality, *threads* limits the encoder threads
+    and *gop* sets the GOP size in frames.'''
+
+    streams = fields['probe']['streams']
+    video = [s for s in streams if s.get('codec_type') == 'video'][0]
+    codec = video.get('codec_name')
+    encoder = VIDEO_ENCODERS.get(codec, codec)
+    args = ['-c:v', encoder]
+    profile = ENCODER_PROFILES.get(encoder, {}).get(video.get('profile'))
+    if profile:
+        args += ['-profile:v', profile]
+    level = _encoder_level(codec, video.get('level', 0))
+    if level and encoder == 'libx264':
+        args += ['-level:v', level]
+    if video.get('pix_fmt'):
+        args += ['-pix_fmt', video['pix_fmt']]
+    if parse_rate(video.get('r_frame_rate', '0/0')):
+        args += ['-r', video['r_frame_rate']]
+    time_base = video.get('time_base', '').partition('/')[2]
+    if time_base:
+        args += ['-video_track_timescale', time_base]
+    args += ['-b:v', '{}k'.format(fields['bitrate'])]
+    if gop:
+        args += ['-g', str(gop)]
+    if preset and encoder in ENCODE_PRESETS[preset]:
+        args += ['-preset', ENCODE_PRESETS[preset][encoder]]
+    if threads:
+        args += ['-threads', str(threads)]
+
+    audio = [s for s in streams if s.get('codec_type') == 'audio']
+    for i, stream in enumerate(audio):
+        args += audio_encode_args(stream, i)
+    return args + ['-strict', '-2']
+
+def audio_encode_args(stream, index):
+    '''Return ffmpeg output arguments that encode output audio stream *index*
+    to match the codec, sample rate, channels and bitrate of the ffprobe audio
+    *stream*.'''
+
+    codec = stream.get('codec_name')
+    args = ['-c:a:{}'.format(index), AUDIO_ENCODERS.get(codec, codec)]
+    if stream.get('sample_rate'):
+        args += ['-ar:a:{}'.format(index), stream['sample_rate']]
+    if stream.get('channels'):
+        args += ['-ac:a:{}'.format(index), str(stream['channels'])]
+    if stream.get('bit_rate'):
+        args += ['-b:a:{}'.format(index), stream['bit_rate']]
+    return args
+
+def parse_rate(rate):
+    '''Parse a frame rate like "30000/1001" from ffprobe into a float, returning
+    0.0 for an unknown rate.'''
+
+    num, _, den = rate.partition('/')
+    if not den:
+        return float(num)
+    if not float(den):
+        return 0.0
+    return float(num) / float(den)
+
+def probe_video(filename):
+    '''Probe the given file with ffprobe and return the video length, video
+    resolution, video bitrate (rounded to nearest 100 kb/s), video fps and the
+    number of audio channels. The full ffprobe data is under the 'probe' key.'''
+
+    data = probe_data(filename)
+    if 'duration' not in data.get('format', {}):
+        _log.error("Can't find video duration in file %s", filename)
         sys.exit(1)
 
-    values = {'duration' : match.group(1)}
+    duration = datetime.timedelta(seconds=float(data['format']['duration']))
+    values = {'duration' : delta_to_str(duration), 'probe' : data}
 
-    vid_pat = 'Stream #0:0.*Video.*, ([0-9]+x[0-9]+), ([^ ]+) kb/s, ([^ ]+) fps'
-    match = re.search(vid_pat, ffprobe_out)
-    if not match:
-        _log.error("Can't find video details in %s\n%s", filename, ffprobe_out)
+    streams = data.get('streams', [])
+    video = [s for s in streams if s.get('codec_type') == 'video']
+    if not video:
+        _log.error("Can't find video details in %s", filename)
         sys.exit(1)
+    video = video[0]
+
+    values['resolution'] = '{}x{}'.format(video.get('width'),
+                                          video.get('height'))
+    bitrate = video.get('bit_rate', data['format'].get('bit_rate'))
+    fps = parse_rate(video.get('avg_frame_rate', '0/0'))
+    if not fps:
+        fps = parse_rate(video.get('r_frame_rate', '0/0'))
     fields = ['resolution', 'bitrate', 'fps']
-    for i,f in enumerate(fields):
-        value = match.group(i + 1)
+    for f, value in zip(fields, [video.get('width'), bitrate, fps]):
         if not value:
             _log.error("Can't find video %s for file %s", f, filename)
             sys.exit(1)
-        values[f] = value
 
-    values['bitrate'] = int(round(int(values['bitrate']), -2))
-    values['fps'] = float(values['fps'])
+    values['bitrate'] = int(round(int(bitrate) / 1000, -2))
+    values['fps'] = fps
     fields = ['duration'] + fields
 
-    num_channels = 0
-    audio_pat = 'Stream #0:([0-9]+).*Audio'
-    for line in ffprobe_out.split('\n'):
-        match = re.search(audio_pat, line)
-        if not match:
-            continue
-
-        num_channels = int(match.group(1))
+    num_channels = len([s for s in streams if s.get('codec_type') == 'audio'])
     values['num_channels'] = num_channels
 
     _log.info('Video Details: Length: %s, Resolution: %s, Bitrate: %d kb/s, '
@@ -0,0 +1,232 @@
+'''Compile an edit of clips, crossfades and volume changes into as few ffmpeg
+commands as we can. Only the crossfades are rendered as intermediate files,
+and the output is written by a single concatenation that copies the video and
+re-encodes only the audio channels with volume changes.'''
+
+import datetime
+import functools
+import logging
+import os
+
+from . import common, merge, scratch, volume
+
+_log = logging.getLogger(__name__)
+
+def _seconds(time):
+    if isinstance(time, str):
+        return common.parse_time(time).total_seconds()
+    return float(time)
+
+def _delta(seconds):
+    return datetime.timedelta(seconds=seconds)
+
+class Timeline:
+    '''An edit made of clips from video files, played in order, with optional
+    crossfades between clips and volume changes over ranges of the output.
+    Times can be given as seconds or as HH:MM:SS[.SSS] strings.'''
+
+    def __init__(self):
+        # Each clip is a (filename, begin, end, crossfade) tuple in seconds,
+        # where crossfade is the length of the crossfade from the clip before.
+        self.clips = []
+        # Each gain is a (start, stop, volume, channel) tuple, with times in
+        # seconds of the output.
+        self.gains = []
+
+    def add_clip(self, filename, begin, end, crossfade=0):
+        '''Add the part of *filename* between *begin* and *end* to the end of
+        the timeline, crossfading from the previous clip over *crossfade*
+        seconds.'''
+
+        begin = _seconds(begin)
+        end = _seconds(end)
+        crossfade = _seconds(crossfade)
+        if end <= begin:
+            raise ValueError('Clip of {} ends before it begins'.format(
+                filename))
+        if crossfade and not self.clips:
+            raise ValueError('The first clip has no clip to crossfade from')
+        if self.clips:
+            previous = self.clips[-1]
+            if crossfade + previous[3] > previous[2] - previous[1]:
+                raise ValueError('Crossfades are longer than the clip of '
+                                 '{}'.format(previous[0]))
+        if crossfade > end - begin:
+            raise ValueError('Crossfade is longer than the clip of {}'.format(
+                filename))
+        self.clips.append((filename, begin, end, crossfade))
+
+    def add_gain(self, start, stop, level, channel=1):
+        '''Set the volume of audio *channel* (numbered from 1) to *level*, any
+        volume accepted by `volume.parse_volume()`, between *start* and *stop*
+        of the output. Where gains overlap, the one added last is used.'''
+
+        self.gains.append((_seconds(start), _seconds(stop), level, channel))
+
+    def duration(self):
+        '''Return the length of the output in seconds.'''
+
+        return sum(end - begin - crossfade
+                   for f, begin, end, crossfade in self.clips)
+
+    def compile(self, output_file, intermediates, encode=None,
+                split_times=None):
+        '''Return stages for `common.run_stages()` that render the timeline to
+        *output_file*, writing the crossfades to the given
+        `merge.Intermediates`. *encode* is passed to `merge.crossfade_args()`.
+        If *split_times* gives times in seconds of the output, the output is
+        split there into files named by the pattern *output_file*, as for
+        ffmpeg's segment muxer.'''
+
+        if not self.clips:
+            raise ValueError('The timeline has no clips')
+
+        fields = {f : common.probe_video(f)
+                  for f in set(c[0] for c in self.clips)}
+        bitrate = max(f['bitrate'] for f in fields.values())
+        copies = self._copy_ranges(fields)
+        stages = {}
+        parts = []
+        for i, (filename, begin, end, crossfade) in enumerate(self.clips):
+            copy_begin, copy_end, bounds = copies[i][:3]
+            if copy_end > copy_begin:
+                duration = common.parse_time(fields[filename]['duration'])
+                part = (filename, copy_begin or None,
+                        copy_end if copy_end < duration else None)
+                if bounds:
+                    # Stop the copy at the keyframe's decoding time, so that
+                    # no frame after it gets in, as for `merge.copy_bounds()`,
+                    # while the part still lasts up to the keyframe.
+                    part = part[:2] + (bounds[0], bounds[1] - copy_begin)
+                parts.append(part)
+            if i + 1 == len(self.clips) or not self.clips[i + 1][3]:
+                continue
+
+            # The crossfade covers the video between the copied parts, which
+            # can run past the crossfade itself to the keyframes they were
+            # snapped to.
+            next_file, next_begin = self.clips[i + 1][:2]
+            crossfade_out = self.clips[i + 1][3]
+            first_range = (copy_end, _delta(end))
+            second_range = (_delta(next_begin), copies[i + 1][3])
+            ffmpeg_args = merge.crossfade_args(filename, next_file,
+                    common.delta_to_str(_delta(crossfade_out)),
+                    fields[filename]['resolution'], fields[filename]['fps'],
+                    bitrate, fields[filename]['num_channels'], None,
+                    first_range, second_range, encode)
+            length = sum((r[1] - r[0]).total_seconds()
+                         for r in [first_range, second_range])
+            path, func = intermediates.stage(ffmpeg_args, filename,
+                    'edl-crossf', 'crossfade_videos',
+                    scratch.estimate_bytes(fields[filename], length))
+            stages['crossfade_videos/{}'.format(i)] = (func, [])
+            parts.append(path)
+
+        ffmpeg_args = self._output_args(fields[self.clips[0][0]],
+                                        output_file, split_times)
+        stages['concat'] = (functools.partial(self._concat, parts,
+                                              ffmpeg_args), list(stages))
+        return stages
+
+    def _copy_ranges(self, fields):
+        # The (begin, end, bounds, fade_end) of the part of each clip outside
+        # its crossfades, as `datetime.timedelta` objects. Ends next to a
+        # crossfade are snapped to keyframes with `merge.snap_times()`, so
+        # the part is copied exactly, unless the clip is too short to hold a
+        # keyframe between them. Where the end is snapped, bounds is the
+        # (outpoint, keyframe) from `merge.copy_bounds()`, and otherwise
+        # None. fade_end is where the crossfade into the clip stops being
+        # rendered, just short of the keyframe the copy begins on.
+        ranges = []
+        for i, (filename, begin, end, crossfade) in enumerate(self.clips):
+            crossfade_out = 0
+            if i + 1 < len(self.clips):
+                crossfade_out = self.clips[i + 1][3]
+            copy_begin = _delta(begin + crossfade)
+            copy_end = _delta(end - crossfade_out)
+            if not crossfade and not crossfade_out:
+                ranges.append((copy_begin, copy_end, None, copy_begin))
+                continue
+
+            keyframes = common.probe_keyframes(filename)
+            duration = fields[filename]['duration']
+            snapped_begin, snapped_end = copy_begin, copy_end
+            fade_end = copy_begin
+            if crossfade:
+                times = merge.snap_times((copy_begin, _delta(end),
+                        _delta(begin), copy_begin), keyframes, False,
+                        duration)
+                snapped_begin, fade_end = times[0], times[3]
+            if crossfade_out:
+                snapped_end = merge.snap_times((snapped_begin, copy_end,
+                        copy_end, _delta(end)), keyframes, True, duration)[1]
+            if snapped_end <= snapped_begin:
+                ranges.append((copy_begin, copy_end, None, copy_begin))
+                continue
+
+            bounds = None
+            if crossfade_out:
+                frames, outpoint, keyframe = merge.copy_bounds(filename,
+                        snapped_begin, snapped_end)
+                if outpoint:
+                    bounds = (outpoint, keyframe)
+            ranges.append((snapped_begin, snapped_end, bounds, fade_end))
+        return ranges
+
+    def _output_args(self, fields, output_file, split_times):
+        # Output arguments for the final concatenation. Video is copied, and
+        # only audio channels with gains are filtered and re-encoded.
+        streams = [s for s in fields['probe']['streams']
+                   if s.get('codec_type') == 'audio']
+        ffmpeg_args = ['-map', '0:v', '-c:v', 'copy']
+        filters = []
+        for n in range(1, fields['num_channels'] + 1):
+            gains = [g for g in self.gains if g[3] == n]
+            if not gains:
+                ffmpeg_args += ['-map', '0:a:{}'.format(n - 1),
+                                '-c:a:{}'.format(n - 1), 'copy']
+                continue
+
+            segments = volume.normalize_segments([g[:2] for g in gains],
+                                                 [g[2] for g in gains])
+            filters.append('[0:a:{}]{}[a{}]'.format(n - 1,
+                    volume.volume_filter(segments, 'gain{}'.format(n)), n))
+            ffmpeg_args += ['-map', '[a{}]'.format(n)]
+            ffmpeg_args += common.audio_encode_args(streams[n - 1], n - 1)
+        if filters:
+            ffmpeg_args = ['-filter_complex', ';'.join(filters)] + ffmpeg_args
+
+        if split_times:
+            ffmpeg_args += ['-f', 'segment', '-segment_times',
+                            ','.join(str(t) for t in sorted(split_times)),
+                            '-reset_timestamps', '1']
+        return ffmpeg_args + ['-y', output_file]
+
+    def _concat(self, parts, ffmpeg_args):
+        list_file = common.write_concat_list(parts)
+        try:
+            common.run_command(['ffmpeg', '-f', 'concat', '-safe', '0', '-i',
+                                list_file] + ffmpeg_args, 'concat_videos')
+        finally:
+            os.remove(list_file)
+
+    def render(self, output_file, jobs=None, delete_temp=True,
+               scratch_dir=None, encode=None, split_times=None):
+        '''Render the timeline to *output_file*, running up to *jobs* ffmpeg
+        processes at once, by default one for each crossfade up to the number
+        of CPUs. Intermediate files are temporary, or kept in *scratch_dir* if
+        given, as for `merge.Intermediates`. *encode* and *split_times* are as
+        for `compile()`.'''
+
+        intermediates = merge.Intermediates(delete_temp, scratch_dir)
+        stages = self.compile(output_file, intermediates, encode, split_times)
+        if not jobs:
+            jobs = max(1, min(len(stages) - 1, os.cpu_count() or 1))
+        if scratch_dir:
+            scratch.prepare(intermediates.needed, scratch_dir,
+                            keep=intermediates.paths)
+        try:
+            common.run_stages(stages, jobs)
+        finally:
+            intermediates.close()
+        _log.info('Timeline written to %s', output_file)
@@ -1,50 +1,139 @@
 #!/usr/bin/env python3
 
-'''Use ffmpeg to merge two video mp4 files with an video+audio crossfade
-between them.'''
+'''Use ffmpeg to merge video mp4 files in order with a video+audio crossfade
+between each pair of consecutive files.'''
 
 import argparse
+import bisect
 import datetime
+import fractions
+import functools
 import logging
+import math
 import os
 import os.path
 import subprocess
 import sys
-import tempfile
-
-from . import common
-
-_log = logging.getLogger()
-_log.setLevel(logging.INFO)
-_log.addHandler(logging.StreamHandler())
-
-def parse_time(time):
-    '''Parse a time in HH:MM:SS[.SSS] format into a `datetime.timedelta`
-    object'''
-    args = dict(zip(['hours', 'minutes', 'seconds'],
-        [float(x) for x in time.split(':')]))
-    return datetime.timedelta(**args)
-
-def delta_to_str(delta):
-    '''Concert a datetime.timedelta into a valid timestamp string for ffmpeg.'''
-    total_sec = delta.total_seconds()
-    hours, remainder = divmod(total_sec, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    return '{:02.0f}:{:02.0f}:{:05.2f}'.format(hours, minutes, seconds)
-
-def make_temp_file(filename=None, desc=None, **kwargs):
-    prefix = ''
-    if filename:
-        prefix = os.path.basename(filename) + '-'
-    if desc:
-        prefix += desc + '-'
-    if prefix:
-        kwargs['prefix'] = prefix
-    if 'dir' not in kwargs:
-        kwargs['dir'] = os.getcwd()
-    if 'suffix' not in kwargs:
-        kwargs['suffix'] = '.mp4'
-    return tempfile.NamedTemporaryFile(**kwargs)
+
+from . import chunked, common, scratch
+
+_log = logging.getLogger(__name__)
+
+# How far short of or past a keyframe to seek, so that timestamps rounded by
+# ffprobe still select the keyframe itself.
+_SNAP_MARGIN = datetime.timedelta(milliseconds=1)
+
+def crossfade_times(video_duration, crossfade_duration, at_end,
+                    crossfade_start=None):
+    '''Return a tuple of `datetime.timedelta` objects (main_begin, main_end,
+    crossfade_begin, crossfade_end) giving the part of the video we want to
+    keep and the part to crossfade. The arguments are as for
+    `crossfade_split()`.'''
+
+    crossfade_duration_delta = common.parse_time(crossfade_duration)
+    video_duration_delta = common.parse_time(video_duration)
+    if crossfade_start:
+        crossfade_begin = common.parse_time(crossfade_start)
+    # Without crossfade_start, the crossfade is crossfade_duration from end of
+    # video if at_end is True, otherwise it's the beginning of the video.
+    elif at_end:
+        crossfade_begin = video_duration_delta - crossfade_duration_delta
+    else:
+        crossfade_begin = datetime.timedelta(0)
+    crossfade_end = crossfade_begin + crossfade_duration_delta
+
+    # If at_end is True, the main part is from the beginning of our input video
+    # until the beginning of the crossfade. If at_end is False, this will be
+    # from the end of the crossfade until the end of the video.
+    if at_end:
+        return (datetime.timedelta(0), crossfade_begin, crossfade_begin,
+                crossfade_end)
+    else:
+        return (crossfade_end, video_duration_delta, crossfade_begin,
+                crossfade_end)
+
+def snap_times(times, keyframes, at_end, video_duration):
+    '''Move the boundary between the main part and the crossfade part in
+    *times*, as returned by `crossfade_times()`, to a keyframe so the main part
+    can be stream-copied exactly. *keyframes* is a sorted list of keyframe
+    times in seconds. The crossfade part grows to cover the video between the
+    keyframe and the crossfade. Returns new times in the same format.'''
+
+    main_begin, main_end, crossfade_begin, crossfade_end = times
+    if at_end:
+        before = [k for k in keyframes if k <= main_end.total_seconds()]
+        keyframe = datetime.timedelta(seconds=before[-1] if before else 0)
+        # Stop just short of the keyframe so it isn't copied into the main
+        # part, and seek just short of it so it's the first frame rendered.
+        boundary = max(keyframe - _SNAP_MARGIN, datetime.timedelta(0))
+        return (main_begin, boundary, boundary, crossfade_end)
+
+    after = [k for k in keyframes if k >= main_begin.total_seconds()]
+    if not after:
+        # No keyframe follows, so we render through to the end of the video.
+        end = common.parse_time(video_duration)
+        return (end, end, crossfade_begin, end)
+
+    keyframe = datetime.timedelta(seconds=after[0])
+    # Seeking the copy just past the keyframe lands on the keyframe, and the
+    # rendered part stops just short of it.
+    return (keyframe + _SNAP_MARGIN, main_end, crossfade_begin,
+            keyframe - _SNAP_MARGIN)
+
+def copy_bounds(filename, begin, end):
+    '''Return (frames, outpoint, keyframe) bounding a stream copy of the
+    video in *filename* from *begin* up to *end*, `datetime.timedelta` objects
+    from `snap_times()` just past and just short of keyframes. *keyframe* is
+    the time of the keyframe after *end*. A copy cut at a duration or at
+    *keyframe* still takes the frames shown after the keyframe but decoded
+    before it, with B-frames, so the copy is cut in decoding order instead:
+    *frames* is the number of video packets from the keyframe the copy starts
+    on up to the keyframe after *end*, and *outpoint* the decoding time of
+    that keyframe, for the concat demuxer. If there's no keyframe after *end*,
+    all three are None.'''
+
+    data = common.probe_data(filename)
+    video = [s for s in data['streams'] if s.get('codec_type') == 'video'][0]
+    time_base = fractions.Fraction(video['time_base'])
+    start_time = fractions.Fraction(data['format'].get('start_time', '0'))
+    packets = common.probe_packets(filename, 'v:0')
+    times = [float(pts * time_base - start_time) for pts, dts, dur in packets]
+    first = max(bisect.bisect_right(times, begin.total_seconds()) - 1, 0)
+    stop = bisect.bisect_left(times, end.total_seconds())
+    if stop == len(packets):
+        return (None, None, None)
+
+    first_dts = packets[first][1]
+    stop_dts = packets[stop][1]
+    frames = sum(1 for pts, dts, dur in packets if first_dts <= dts < stop_dts)
+    # Round down, so the keyframe's packet is past the outpoint.
+    outpoint = datetime.timedelta(
+        microseconds=math.floor(stop_dts * time_base * 1000000))
+    return (frames, outpoint, datetime.timedelta(seconds=times[stop]))
+
+def copy_segment(filename, begin, end, desc, delete_temp=True):
+    '''Stream-copy the video in *filename* between the `datetime.timedelta`
+    objects *begin* and *end* into a temporary file, seeking on the input side.
+    Returns the temporary file object.'''
+
+    out_fh = common.make_temp_file(filename, desc, delete=delete_temp)
+    common.run_command(copy_args(filename, begin, end, out_fh.name),
+                       'crossfade_split/' + desc)
+    return out_fh
+
+def copy_args(filename, begin, end, out_filename, frames=None):
+    '''Return the ffmpeg arguments for `copy_segment()`, writing the copy to
+    *out_filename*. If *frames* is given, as from `copy_bounds()`, the copy
+    holds at most that many video frames.'''
+
+    ffmpeg_args = ['ffmpeg']
+    if begin:
+        ffmpeg_args += ['-ss', str(begin.total_seconds())]
+    ffmpeg_args += ['-i', filename, '-map', '0', '-c', 'copy', '-t',
+                    str((end - begin).total_seconds())]
+    if frames:
+        ffmpeg_args += ['-frames:v', str(frames)]
+    return ffmpeg_args + ['-y', out_filename]
 
 def crossfade_split(filename, video_duration, crossfade_duration, at_end,
                     crossfade_start=None, delete_temp=True):
@@ -59,84 +148,72 @@ def crossfade_split(filename, video_duration, crossfade_duration, at_end,
     begins *crossfade_duration* from the end/beginning of the video, depending
     on *at_end*.'''
 
-    ffmpeg_args = ['ffmpeg', '-i', filename, '-map', '0', '-c', 'copy']
-    crossfade_duration_delta = parse_time(crossfade_duration)
-    video_duration_delta = parse_time(video_duration)
-    begin_delta = None
-    end_delta = None
-    if crossfade_start:
-        crossfade_start_delta = parse_time(crossfade_start)
-
-    # We create the first video, creating begin_delta and end_delta relative to
-    # the original video and have ffmpeg trim out anything not between these.
-    # If at_end is True, this will be from the beginning of our input video
-    # until the beginning of the crossfade. If at_end is False, this will be
-    # from the end of the crossfade until the end of the video.
-    if crossfade_start:
-        if at_end:
-            end_delta = crossfade_start_delta
-        else:
-            begin_delta = crossfade_start_delta + crossfade_duration_delta
-    # Since we don't have crossfade_start, beginning of crossfade is
-    # crossfade_duration from end of video if at_end is True, otherwise it's
-    # the beginning of the video.
-    else:
-        if at_end:
-            end_delta = video_duration_delta - crossfade_duration_delta
-        else:
-            begin_delta = crossfade_duration_delta
-
-    if begin_delta:
-        ffmpeg_args += ['-ss', delta_to_str(begin_delta)]
-
-    if end_delta:
-        ffmpeg_args += ['-to', delta_to_str(end_delta)]
-
-    main_fh = make_temp_file(filename, 'main', delete=delete_temp)
-    ffmpeg_args += ['-y', main_fh.name]
-    common.run_command(ffmpeg_args)
-
-    # Create the second video containing a portion to be crossfaded.
-    ffmpeg_args = ['ffmpeg', '-i', filename, '-map', '0', '-c', 'copy']
-
-    begin_delta = None
-    end_delta = None
-    if crossfade_start:
-        begin_delta = crossfade_start_delta
-        end_delta = crossfade_start_delta + crossfade_duration_delta
-    else:
-        if at_end:
-            begin_delta = video_duration_delta - crossfade_duration_delta
-        else:
-            end_delta = crossfade_duration_delta
-
-    if begin_delta:
-        ffmpeg_args += ['-ss', delta_to_str(begin_delta)]
-    if end_delta:
-        ffmpeg_args += ['-to', delta_to_str(end_delta)]
-
-    crossfade_fh = make_temp_file(filename, 'crossf', delete=delete_temp)
-    ffmpeg_args += ['-y', crossfade_fh.name]
-    common.run_command(ffmpeg_args)
-
+    main_begin, main_end, crossfade_begin, crossfade_end = crossfade_times(
+        video_duration, crossfade_duration, at_end, crossfade_start)
+    main_fh = copy_segment(filename, main_begin, main_end, 'main', delete_temp)
+    crossfade_fh = copy_segment(filename, crossfade_begin, crossfade_end,
+                                'crossf', delete_temp)
     return (main_fh, crossfade_fh)
 
 def crossfade_videos(first_file, second_file, duration_time, resolution, fps,
-                     bitrate, num_channels, delete_temp=True):
+                     bitrate, num_channels, delete_temp=True, first_range=None,
+                     second_range=None, encode=None):
     '''Given two videos of the same duration, merge their video/audio channels
-    using a crossfade from the first video to the second.'''
+    using a crossfade from the first video to the second. If *first_range* is
+    given as a (begin, end) pair of `datetime.timedelta` objects, only that
+    part of the first video is used, with the video before the last
+    *duration_time* of the range played unchanged ahead of the crossfade.
+    Likewise *second_range* selects part of the second video, with the video
+    after its first *duration_time* played unchanged after the crossfade.
+    If *encode* is given as a list of ffmpeg output arguments, such as from
+    `common.encode_args()`, they're used in place of our default encoding
+    settings.'''
+
+    out_file = common.make_temp_file(desc='final-crossf', delete=delete_temp)
+    common.run_command(crossfade_args(first_file, second_file, duration_time,
+            resolution, fps, bitrate, num_channels, out_file.name, first_range,
+            second_range, encode), 'crossfade_videos')
+    return out_file
 
-    ffmpeg_args = ['ffmpeg', '-i', first_file, '-i', second_file]
-    duration_sec = parse_time(duration_time).total_seconds()
+def crossfade_args(first_file, second_file, duration_time, resolution, fps,
+                   bitrate, num_channels, out_filename, first_range=None,
+                   second_range=None, encode=None):
+    '''Return the ffmpeg arguments for `crossfade_videos()`, writing the
+    crossfade to *out_filename*.'''
+
+    duration_sec = common.parse_time(duration_time).total_seconds()
+    ffmpeg_args = ['ffmpeg']
+    lead_in = 0
+    lead_out = 0
+    for i, (filename, seek_range) in enumerate([(first_file, first_range),
+                                                (second_file, second_range)]):
+        if seek_range:
+            begin, end = seek_range
+            length = (end - begin).total_seconds()
+            ffmpeg_args += ['-ss', str(begin.total_seconds()), '-t',
+                            str(length)]
+            # Ranges from snap_times() run just past keyframes, so the video
+            # played unchanged is rounded to whole frames.
+            lead = max(length - duration_sec, 0)
+            if fps:
+                lead = round(lead * fps) / fps
+            if i == 0:
+                lead_in = round(lead, 6)
+            else:
+                lead_out = round(lead, 6)
+        ffmpeg_args += ['-i', filename]
 
     # Video filter
-    # Make a black overlay at desired resolution for the length of the crossfade.
-    filter = 'color=black:{}:d={}[base]; '.format(resolution, duration_sec)
-    # Make fifo and setpts for first video.
-    filter += '[0:v]fifo,setpts=PTS-STARTPTS[v0];'
-    # Make fifo and fadein second video at t=0, do setpts.
-    filter += ('[1:v]fifo,format=yuva420p,fade=in:st=0:d={}:alpha=1'
-               ',setpts=PTS-STARTPTS[v1];').format(duration_sec)
+    # Make a black overlay at desired resolution and frame rate for the length
+    # of the output.
+    filter = 'color=black:{}:r={}:d={}[base]; '.format(resolution, fps,
+            round(lead_in + duration_sec + lead_out, 6))
+    # Reset the timestamps of the first video.
+    filter += '[0:v]setpts=PTS-STARTPTS[v0];'
+    # Fade in the second video at t=0, do setpts so that it starts
+    # once the first video reaches the crossfade.
+    filter += ('[1:v]format=yuva420p,fade=in:st=0:d={}:alpha=1'
+               ',setpts=PTS-STARTPTS+{}/TB[v1];').format(duration_sec, lead_in)
     # Overlay base and first video, then overaly that and second video.
     filter += '[base][v0]overlay[tmp]; [tmp][v1]overlay,format=yuv420p[fv]; '
 
@@ -152,39 +229,276 @@ def crossfade_videos(first_file, second_file, duration_time, resolution, fps,
     ffmpeg_args += ['-filter_complex', filter, '-map', '[fv]']
     for i in range(0, num_channels):
         ffmpeg_args += ['-map', '[fa{}]'.format(i)]
-    ffmpeg_args += ['-r', str(fps), '-b:v', str(bitrate) + 'k', '-strict',
-            '-2', '-ac', '-2']
-    out_file = make_temp_file(desc='final-crossf', delete=delete_temp)
-    ffmpeg_args += ['-y', out_file.name]
-
-    common.run_command(ffmpeg_args)
-    return out_file
-
-def concat_videos(files, output_filename, delete_temp=True):
+    if encode:
+        ffmpeg_args += encode
+    else:
+        ffmpeg_args += ['-r', str(fps), '-b:v', str(bitrate) + 'k', '-strict',
+                '-2', '-ac', '-2']
+    return ffmpeg_args + ['-y', out_filename]
+
+def crossfade_chunk_args(first_file, second_file, duration_time, resolution,
+                         fps, bitrate, first_range, second_range, encode, gop,
+                         begin, end, frames, out_filename):
+    '''Return the ffmpeg arguments rendering only the video of the crossfade
+    from `crossfade_args()` between *begin* and *end* seconds of its output,
+    *frames* frames long, for `chunked.render_chunked()`. Both ranges must be
+    given, and keyframes are placed every *gop* frames.'''
+
+    duration_sec = common.parse_time(duration_time).total_seconds()
+    first_length = (first_range[1] - first_range[0]).total_seconds()
+    lead_in = round(max(first_length - duration_sec, 0) * fps) / fps
+
+    # Seek each file to the part shown in this chunk, leaving out a file that
+    # isn't shown at all.
+    ffmpeg_args = ['ffmpeg']
+    filter = 'color=black:{}:r={}:d={}[base]; '.format(resolution, fps,
+            round(end - begin, 6))
+    top = 'base'
+    if begin < first_length:
+        ffmpeg_args += ['-ss', str(round(
+                            first_range[0].total_seconds() + begin, 6)),
+                        '-t', str(round(min(end, first_length) - begin, 6)),
+                        '-i', first_file]
+        filter += ('[0:v]setpts=PTS-STARTPTS[v0]; '
+                   '[base][v0]overlay[tmp]; ')
+        top = 'tmp'
+    if end > lead_in:
+        # Fade in the second video from where this chunk is in the fade, by
+        # giving its frames their times in the fade before shifting them to
+        # their times in the chunk.
+        offset = round(max(begin - lead_in, 0), 6)
+        index = 0 if top == 'base' else 1
+        ffmpeg_args += ['-ss', str(round(
+                            second_range[0].total_seconds() + offset, 6)),
+                        '-t', str(round(end - max(begin, lead_in), 6)),
+                        '-i', second_file]
+        filter += ('[{}:v]format=yuva420p,setpts=PTS-STARTPTS+{}/TB,'
+                   'fade=in:st=0:d={}:alpha=1,setpts=PTS-STARTPTS+{}/TB[v1]; '
+                   '[{}][v1]overlay[top]; ').format(index, offset,
+                           duration_sec, round(max(lead_in - begin, 0), 6),
+                           top)
+        top = 'top'
+    filter += '[{}]format=yuv420p[fv]'.format(top)
+
+    ffmpeg_args += ['-filter_complex', filter, '-map', '[fv]', '-frames:v',
+                    str(frames)]
+    if encode:
+        ffmpeg_args += encode
+    else:
+        ffmpeg_args += ['-r', str(fps), '-b:v', str(bitrate) + 'k']
+    if '-g' not in ffmpeg_args:
+        ffmpeg_args += ['-g', str(gop)]
+    return ffmpeg_args + ['-y', out_filename]
+
+def crossfade_audio_args(first_file, second_file, duration_time, num_channels,
+                         first_range, second_range, encode, out_filename):
+    '''Return the ffmpeg arguments rendering only the audio of the crossfade
+    from `crossfade_args()`, for `chunked.render_chunked()`.'''
+
+    duration_sec = common.parse_time(duration_time).total_seconds()
+    ffmpeg_args = ['ffmpeg']
+    for filename, (begin, end) in [(first_file, first_range),
+                                   (second_file, second_range)]:
+        ffmpeg_args += ['-ss', str(begin.total_seconds()), '-t',
+                        str((end - begin).total_seconds()), '-i', filename]
+    filter = ';'.join('[0:a:{0}][1:a:{0}]acrossfade=d={1}[fa{0}]'.format(
+                          i, duration_sec) for i in range(num_channels))
+    ffmpeg_args += ['-filter_complex', filter]
+    for i in range(num_channels):
+        ffmpeg_args += ['-map', '[fa{}]'.format(i)]
+    if encode:
+        ffmpeg_args += encode
+    else:
+        ffmpeg_args += ['-strict', '-2', '-ac', '-2']
+    return ffmpeg_args + ['-y', out_filename]
+
+class Intermediates:
+    '''Where the intermediate files of a merge are written: either temporary
+    files, removed when closed unless *delete_temp* is False, or files in the
+    scratch directory *scratch_dir* that are reused by later runs.'''
+
+    def __init__(self, delete_temp=True, scratch_dir=None):
+        self.delete_temp = delete_temp
+        self.scratch_dir = scratch_dir
+        self.temp_fhs = []
+        # Estimated bytes of the scratch files we still need to make.
+        self.needed = 0
+        # The scratch files this merge reuses or makes, kept from eviction.
+        self.paths = set()
+
+    def stage(self, ffmpeg_args, filename, desc, stage, size=0, make=None):
+        '''Return a (path, function) pair for a stage running *ffmpeg_args*,
+        replacing its last argument with the path of the intermediate file it
+        writes, of about *size* bytes. *filename* and *desc* name a temporary
+        file and *stage* tags the command's telemetry. If *make* is given, the
+        stage calls it with the path to write instead of running
+        *ffmpeg_args*, which then only identify the file.'''
+
+        if self.scratch_dir:
+            path = scratch.artifact_path(ffmpeg_args, self.scratch_dir)
+            ffmpeg_args[-1] = path
+            self.paths.add(path)
+            if not os.path.exists(path):
+                self.needed += size
+            return (path, functools.partial(scratch.run_artifact, ffmpeg_args,
+                                            stage, make))
+
+        fh = common.make_temp_file(filename, desc, delete=self.delete_temp)
+        self.temp_fhs.append(fh)
+        ffmpeg_args[-1] = fh.name
+        if make:
+            return (fh.name, functools.partial(make, fh.name))
+        return (fh.name, functools.partial(common.run_command, ffmpeg_args,
+                                           stage))
+
+    def close(self):
+        '''Close the temporary files, removing them unless we keep them.'''
+
+        for fh in self.temp_fhs:
+            fh.close()
+
+def crossfade_stages(files, fields, boundaries, bitrate, intermediates,
+                     accurate=False, encode=None, backend=None, gop=None):
+    '''Return stages for `common.run_stages()` that render the crossfades
+    between each pair of consecutive videos in *files*. *fields* holds the
+    `common.probe_video()` fields of each file and *boundaries* holds a
+    (first_times, second_times, crossfade_duration) tuple for each pair, where
+    the times are as returned by `crossfade_times()` or `snap_times()`. If
+    *accurate* is True, we seek directly in the original files so the
+    crossfade parts begin and end at the exact times, otherwise the crossfade
+    parts are first stream-copied by their own stages. Files are written to
+    the given `Intermediates` and *encode* is passed to `crossfade_args()`.
+    If a *backend* from `chunked` is given, crossfades longer than a GOP of
+    *gop* frames are encoded in up to as many chunks as the backend's jobs.
+    Returns a tuple of the stages dict and the list of rendered crossfade
+    filenames.'''
+
+    stages = {}
+    out_files = []
+    for i, (first_times, second_times, duration) in enumerate(boundaries):
+        sources = []
+        deps = []
+        length = 0
+        for j, (filename, times) in enumerate([(files[i], first_times),
+                                               (files[i + 1], second_times)]):
+            begin, end = times[2:]
+            seconds = (end - begin).total_seconds()
+            length += seconds
+            if accurate:
+                sources.append((filename, (begin, end)))
+                continue
+
+            name = 'crossfade_split/crossf/{}/{}'.format(i, j)
+            path, func = intermediates.stage(
+                    copy_args(filename, begin, end, None), filename, 'crossf',
+                    'crossfade_split/crossf',
+                    scratch.estimate_bytes(fields[i + j], seconds))
+            stages[name] = (func, [])
+            deps.append(name)
+            sources.append((path, None))
+
+        ffmpeg_args = crossfade_args(sources[0][0], sources[1][0], duration,
+                fields[i]['resolution'], fields[i]['fps'], bitrate,
+                fields[i]['num_channels'], None, sources[0][1], sources[1][1],
+                encode)
+        make = None
+        if backend:
+            # Copied sources are used whole, from the start of the file.
+            ranges = [seek_range if seek_range else
+                      (datetime.timedelta(0), times[3] - times[2])
+                      for (f, seek_range), times in zip(sources,
+                          [first_times, second_times])]
+            make = chunked_crossfade(sources[0][0], sources[1][0], ranges[0],
+                    ranges[1], fields[i], bitrate, duration, encode, backend,
+                    gop, intermediates.delete_temp)
+        if make:
+            # Chunked and single encodes differ, so they're kept apart in the
+            # scratch directory.
+            ffmpeg_args[-1:] = ['-chunks', str(backend.jobs), '-g', str(gop),
+                                None]
+        path, func = intermediates.stage(ffmpeg_args, None, 'final-crossf',
+                'crossfade_videos', scratch.estimate_bytes(fields[i], length),
+                make)
+        stages['crossfade_videos/{}'.format(i)] = (func, deps)
+        out_files.append(path)
+    return (stages, out_files)
+
+def chunked_crossfade(first_file, second_file, first_range, second_range,
+                      fields, bitrate, duration, encode, backend, gop,
+                      delete_temp=True):
+    '''Return a function writing the crossfade from `crossfade_args()` to the
+    file it's called with, by encoding the video in GOP-aligned chunks run by
+    *backend*, or None if the crossfade is too short to split. Both ranges
+    must be given, and *fields* are the `common.probe_video()` fields of the
+    first file.'''
+
+    length = ((first_range[1] - first_range[0]) +
+              (second_range[1] - second_range[0]) -
+              common.parse_time(duration)).total_seconds()
+    bounds = chunked.chunk_bounds(length, fields['fps'], gop, backend.jobs)
+    if len(bounds) < 2:
+        return None
+
+    chunk_args = functools.partial(crossfade_chunk_args, first_file,
+            second_file, duration, fields['resolution'], fields['fps'],
+            bitrate, first_range, second_range, encode, gop)
+    audio_args = None
+    if fields['num_channels']:
+        audio_args = functools.partial(crossfade_audio_args, first_file,
+                second_file, duration, fields['num_channels'], first_range,
+                second_range, encode)
+    return functools.partial(chunked.render_chunked, chunk_args, audio_args,
+                             bounds, backend=backend, delete_temp=delete_temp,
+                             stage='crossfade_videos')
+
+def concat_videos(files, output_filename, delete_temp=True,
+                  stream_format=None):
     '''Use ffmpeg to concatenate the given list of files, in order, into a
-    single video.'''
-
-    input_fh = make_temp_file(desc='vid-list', mode='w+', suffix='.txt',
-                              delete=False)
-    for f in files:
-        input_fh.write("file '{}'\n".format(f))
-    input_fh.close()
-    subprocess.run(['cat', input_fh.name])
-    ffmpeg_args = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', input_fh.name,
-            '-map', '0', '-c', 'copy', output_filename]
+    single video. An entry of *files* can also be a (filename, inpoint,
+    outpoint) tuple to use only the part of the file between the
+    `datetime.timedelta` objects *inpoint* and *outpoint*, either of which can
+    be None, without making a copy of that part, and an optional fourth item
+    as for `common.write_concat_list()`. *output_filename* can be "-" for
+    stdout, and *stream_format* is as for `common.output_args()`.'''
+
+    list_file = common.write_concat_list(files)
+    # Keep stdout for the video when streaming it.
+    subprocess.run(['cat', list_file], stdout=sys.stderr)
+    ffmpeg_args = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_file,
+            '-map', '0', '-c', 'copy']
+    ffmpeg_args += common.output_args(output_filename, stream_format)
     try:
-        common.run_command(ffmpeg_args)
+        common.run_command(ffmpeg_args, 'concat_videos')
     finally:
         if delete_temp:
-            os.remove(input_fh.name)
+            os.remove(list_file)
 
 
+def parse_boundary(spec, default_duration):
+    '''Parse a crossfade boundary given as "<time>,<time>[,<duration>]" into a
+    (start_first, start_second, duration) tuple. Either time can be left empty
+    to use the default crossfade start for that file.'''
+
+    fields = spec.split(',')
+    if len(fields) not in (2, 3):
+        _log.error('Invalid crossfade boundary: %s', spec)
+        sys.exit(1)
+    if len(fields) == 2 or not fields[2]:
+        fields[2:] = [default_duration]
+    return tuple(f if f else None for f in fields)
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('files', nargs=2, metavar='<filename>',
-                        help='An mp4 video file to merge')
+    parser.add_argument('files', nargs='+', metavar='<filename>',
+                        help='An mp4 video file to merge, in order')
     parser.add_argument('-o', dest='outfile', metavar='<filename>',
-                        default='out.mp4', help='Output video filename')
+                        default='out.mp4', help='Output video filename, or '
+                        '- to write to stdout')
+    parser.add_argument('-F', dest='stream_format', metavar='<format>',
+            choices=sorted(common.STREAM_FORMATS), default=None,
+            help="Write the output so it can be read while it's written, as "
+            'one of: {} (default for stdout or a FIFO: mp4)'.format(
+                ', '.join(sorted(common.STREAM_FORMATS))))
     parser.add_argument('-s1', dest='start_first', metavar='<time>',
             default=None, help='When to start the crossfade in the first file')
     parser.add_argument('-s2', dest='start_second', metavar='<time>',
@@ -192,41 +506,178 @@ def main():
     parser.add_argument('-d', dest='crossfade_duration', metavar='<HH:MM:SS>',
                         default='00:00:05',
                         help='How long for the crossfade to take.')
+    parser.add_argument('-b', dest='boundaries', action='append',
+            metavar='<time>,<time>[,<HH:MM:SS>]', default=None,
+            help='When to start the crossfade in the earlier and later file '
+            'at each boundary between consecutive files, and optionally how '
+            'long it takes. Give once for each boundary, in order')
+    parser.add_argument('-j', dest='jobs', metavar='N', type=int, default=None,
+            help='Run up to N ffmpeg processes at once (default: two for each '
+            'file, up to the number of cores)')
+    parser.add_argument('-m', dest='match', action='store_true',
+            default=False, help='Encode the crossfades to match the codec '
+            'settings of the first file, so they join cleanly with the copied '
+            'parts')
+    parser.add_argument('-p', dest='preset', metavar='<preset>',
+            choices=sorted(common.ENCODE_PRESETS), default=None,
+            help='With -m, trade encoding speed for quality with one of: '
+            '{}'.format(', '.join(sorted(common.ENCODE_PRESETS))))
+    parser.add_argument('-t', dest='threads', metavar='N', type=int,
+            default=None, help='With -m, threads for each crossfade encode')
+    parser.add_argument('-c', dest='chunks', metavar='N', type=int,
+            default=None, help='Encode each crossfade in up to N chunks at '
+            'once, split at GOP boundaries and joined without re-encoding')
+    parser.add_argument('-w', dest='scratch_dir', metavar='<dir>',
+            default=None, help='Keep intermediate files in this scratch '
+            'directory and reuse them in later runs with the same inputs')
     parser.add_argument('-k', dest='delete_temp', action='store_false',
                         default=True, help='Keep all temporary files made')
+    parser.add_argument('-a', dest='accurate', action='store_true',
+                        default=False, help='Cut at the exact crossfade times, '
+                        'stream-copying up to the nearest keyframes and '
+                        're-encoding only the video between them')
+    parser.add_argument('-z', dest='zero_copy', action='store_true',
+                        default=False, help='Read the main parts directly '
+                        'from the input files instead of copying them to '
+                        'temporary files first')
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    common.set_tool('vid-merge')
 
-    first_fields = common.probe_video(args.files[0])
-    second_fields = common.probe_video(args.files[1])
-    check_fields = ['resolution', 'fps']
-    for f in check_fields:
-        if first_fields[f] != second_fields[f]:
-            _log.error("Error: %s (%s) of first file %s doesn't match %s (%s)"
-                    "of second file %s", f, first_fields[f], args.files[0], f,
-                    second_fields[f], args.files[1])
+    files = args.files
+    if len(files) < 2:
+        _log.error('Error: At least two files are needed to merge')
+        sys.exit(1)
+    for filename in files:
+        # Inputs are probed and read in several parts, so can't be pipes.
+        if common.is_pipe(filename):
+            _log.error("Error: Can't merge %s, since it's a pipe", filename)
             sys.exit(1)
 
-    if first_fields['num_channels'] != second_fields['num_channels']:
-        _log.error("Error: Number of audio channels in files doesn't match")
-        sys.exit(1)
+    if args.boundaries:
+        if args.start_first or args.start_second:
+            _log.error('Error: -b cannot be used with -s1 or -s2')
+            sys.exit(1)
+        if len(args.boundaries) != len(files) - 1:
+            _log.error('Error: Give -b once for each of the %d boundaries '
+                       'between files', len(files) - 1)
+            sys.exit(1)
+        boundaries = [parse_boundary(b, args.crossfade_duration)
+                      for b in args.boundaries]
+    else:
+        if len(files) > 2 and (args.start_first or args.start_second):
+            _log.error('Error: Use -b to set crossfade starts for more than '
+                       'two files')
+            sys.exit(1)
+        boundaries = [(args.start_first, args.start_second,
+                       args.crossfade_duration)]
+        boundaries += [(None, None, args.crossfade_duration)] * (len(files) - 2)
+
+    # Probe all files at once, including their keyframes if we need them.
+    def probe(filename):
+        fields = common.probe_video(filename)
+        if args.accurate or args.chunks:
+            common.probe_keyframes(filename)
+        return fields
+
+    jobs = args.jobs if args.jobs else min(2 * len(files), os.cpu_count() or 1)
+    probes = common.run_stages({f : (functools.partial(probe, f), [])
+                                for f in set(files)}, jobs)
+    fields = [probes[f] for f in files]
+    check_fields = ['resolution', 'fps']
+    for i in range(1, len(files)):
+        for f in check_fields:
+            if fields[0][f] != fields[i][f]:
+                _log.error("Error: %s (%s) of file %s doesn't match %s (%s) "
+                        "of file %s", f, fields[0][f], files[0], f,
+                        fields[i][f], files[i])
+                sys.exit(1)
+
+        if fields[0]['num_channels'] != fields[i]['num_channels']:
+            _log.error("Error: Number of audio channels in files doesn't match")
+            sys.exit(1)
 
-    # Split each file into two files, the first having all video we want to keep,
-    # and the second having video to crossfade.
-    first_main_fh, first_crossfade_fh = crossfade_split(args.files[0],
-            first_fields['duration'], args.crossfade_duration, True,
-            args.start_first, args.delete_temp)
-    second_main_fh, second_crossfade_fh = crossfade_split(args.files[1],
-            second_fields['duration'], args.crossfade_duration, False,
-            args.start_second, args.delete_temp)
-
-    bitrate = max(first_fields['bitrate'], second_fields['bitrate'])
-    crossfade_fh = crossfade_videos(first_crossfade_fh.name,
-            second_crossfade_fh.name, args.crossfade_duration,
-            first_fields['resolution'], first_fields['fps'], bitrate,
-            first_fields['num_channels'], args.delete_temp)
-    first_crossfade_fh.close()
-    second_crossfade_fh.close()
-
-    temp_files = [fh.name for fh in (first_main_fh, crossfade_fh, second_main_fh)]
-    concat_videos(temp_files, args.outfile, args.delete_temp)
+    # For each boundary, find the times of the main and crossfade parts of the
+    # earlier and later file.
+    boundary_times = []
+    for i, (start_first, start_second, duration) in enumerate(boundaries):
+        pair = []
+        for filename, file_fields, start, at_end in [
+                (files[i], fields[i], start_first, True),
+                (files[i + 1], fields[i + 1], start_second, False)]:
+            times = crossfade_times(file_fields['duration'], duration, at_end,
+                                    start)
+            if args.accurate:
+                times = snap_times(times, common.probe_keyframes(filename),
+                        at_end, file_fields['duration'])
+            pair.append(times)
+        boundary_times.append((pair[0], pair[1], duration))
+
+    bitrate = max(f['bitrate'] for f in fields)
+    gop = None
+    if args.accurate or args.chunks:
+        gop = common.gop_size(common.probe_keyframes(files[0]),
+                              fields[0]['fps'])
+    encode = None
+    if args.match:
+        encode = common.encode_args(dict(fields[0], bitrate=bitrate),
+                                    args.preset, args.threads, gop)
+    backend = None
+    if args.chunks and args.chunks > 1:
+        backend = chunked.LocalBackend(args.chunks, args.threads)
+        # Without enough keyframes to tell, use two-second GOPs.
+        gop = gop if gop else max(1, int(round(2 * fields[0]['fps'])))
+    intermediates = Intermediates(args.delete_temp, args.scratch_dir)
+    stages, crossfade_files = crossfade_stages(files, fields, boundary_times,
+            bitrate, intermediates, args.accurate, encode, backend, gop)
+
+    # The main part of each file runs from the end of the crossfade at its
+    # start to the beginning of the crossfade at its end. These parts are
+    # either referenced in the original files or stream-copied into temporary
+    # files alongside the crossfade stages.
+    parts = []
+    for i, filename in enumerate(files):
+        duration = common.parse_time(fields[i]['duration'])
+        main_begin = boundary_times[i - 1][1][0] if i > 0 else None
+        main_end = boundary_times[i][0][1] if i < len(files) - 1 else None
+        begin = main_begin if main_begin else datetime.timedelta(0)
+        end = main_end if main_end else duration
+        if end <= begin:
+            pass
+        elif args.zero_copy:
+            part = (filename, main_begin, main_end if end < duration else None)
+            if args.accurate and end < duration:
+                frames, outpoint, keyframe = copy_bounds(filename, begin, end)
+                if outpoint:
+                    # The part still lasts up to the keyframe, though the
+                    # audio stops at the outpoint along with the video.
+                    part = (filename, main_begin, outpoint, keyframe - begin)
+            parts.append(part)
+        else:
+            frames = None
+            if args.accurate and end < duration:
+                frames = copy_bounds(filename, begin, end)[0]
+            path, func = intermediates.stage(copy_args(filename, begin, end,
+                    None, frames), filename, 'main', 'crossfade_split/main',
+                    scratch.estimate_bytes(fields[i],
+                                           (end - begin).total_seconds()))
+            stages['crossfade_split/main/{}'.format(i)] = (func, [])
+            parts.append(path)
+
+        if i < len(crossfade_files):
+            parts.append(crossfade_files[i])
+
+    stages['concat_videos'] = (functools.partial(concat_videos, parts,
+            args.outfile, args.delete_temp, args.stream_format),
+            list(stages))
+    if args.scratch_dir:
+        scratch.prepare(intermediates.needed, args.scratch_dir,
+                        keep=intermediates.paths)
+    try:
+        common.run_stages(stages, jobs)
+    finally:
+        intermediates.close()
     _log.info('Video writen to %s', args.outfile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+'''Read the metadata of MP4 and MOV files directly from their boxes, without
+running ffprobe. The file is memory-mapped and only the boxes we need in the
+`moov` box are read, so probing is fast even for long recordings.'''
+
+import array
+import fractions
+import logging
+import mmap
+import struct
+import sys
+
+_log = logging.getLogger(__name__)
+
+# Codec names as ffprobe reports them for the sample entry types we know.
+CODECS = {
+    'avc1' : 'h264', 'avc3' : 'h264', 'hvc1' : 'hevc', 'hev1' : 'hevc',
+    'av01' : 'av1', 'vp09' : 'vp9', 'mp4v' : 'mpeg4', 'mp4a' : 'aac',
+    'Opus' : 'opus', 'ac-3' : 'ac3', 'ec-3' : 'eac3', 'fLaC' : 'flac',
+    'alac' : 'alac', '.mp3' : 'mp3',
+}
+
+# MPEG-4 object types of mp4a sample entries that aren't AAC.
+_OBJECT_TYPES = {0x69 : 'mp3', 0x6b : 'mp3', 0xa5 : 'ac3', 0xa6 : 'eac3'}
+
+_H264_PROFILES = {66 : 'Baseline', 77 : 'Main', 88 : 'Extended', 100 : 'High',
+                  110 : 'High 10', 122 : 'High 4:2:2',
+                  244 : 'High 4:4:4 Predictive'}
+_HEVC_PROFILES = {1 : 'Main', 2 : 'Main 10', 3 : 'Main Still Picture',
+                  4 : 'Rext'}
+_CHROMA_FORMATS = {0 : 'gray', 1 : 'yuv420p', 2 : 'yuv422p', 3 : 'yuv444p'}
+
+class Unsupported(Exception):
+    '''Raised for a file we can't read, which ffprobe should probe instead.'''
+
+def _boxes(buf, start, end):
+    # Yield the (type, payload start, end) of each box between start and end.
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', buf, pos + 8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise Unsupported('Bad box size at offset {}'.format(pos))
+        yield kind.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+def _find(buf, start, end, *path):
+    # Return the (payload start, end) of the first box found along path, or
+    # None if there isn't one.
+    for kind, box_start, box_end in _boxes(buf, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return (box_start, box_end)
+            return _find(buf, box_start, box_end, *path[1:])
+    return None
+
+def _need(buf, start, end, *path):
+    box = _find(buf, start, end, *path)
+    if not box:
+        raise Unsupported('No {} box'.format('/'.join(path)))
+    return box
+
+def _timing(buf, start):
+    # Return the (timescale, duration) of an mvhd or mdhd box.
+    if buf[start] == 1:
+        return struct.unpack_from('>IQ', buf, start + 20)
+    return struct.unpack_from('>II', buf, start + 12)
+
+def _table(buf, start, count, fmt='I'):
+    # Read count big-endian 32-bit values starting at start.
+    values = array.array(fmt)
+    values.frombytes(buf[start:start + 4 * count])
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+def _runs(buf, box):
+    # Read the (count, value) runs of an stts or ctts box, with ctts offsets
+    # read as signed.
+    start, end = box
+    count, = struct.unpack_from('>I', buf, start + 4)
+    values = _table(buf, start + 8, 2 * count, 'i' if buf[start] else 'I')
+    return list(zip(values[::2], values[1::2]))
+
+def _descriptor(buf, pos):
+    # Return the tag, payload start and end of an MPEG-4 descriptor.
+    tag = buf[pos]
+    size = 0
+    pos += 1
+    for i in range(4):
+        byte = buf[pos]
+        pos += 1
+        size = (size << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            break
+    return tag, pos, pos + size
+
+def _object_type(buf, esds):
+    # Return the object type of the decoder config in an esds box.
+    tag, start, end = _descriptor(buf, esds[0] + 4)
+    if tag != 3:
+        return None
+    flags = buf[start + 2]
+    pos = start + 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + buf[pos]
+    if flags & 0x20:
+        pos += 2
+    tag, start, end = _descriptor(buf, pos)
+    return buf[start] if tag == 4 else None
+
+def _video_details(buf, entry_start, entry_end, codec):
+    # Return the ffprobe fields of a visual sample entry, reading the profile,
+    # level and pixel format from its decoder configuration where we can.
+    width, height = struct.unpack_from('>HH', buf, entry_start + 24)
+    stream = {'codec_type' : 'video', 'width' : width, 'height' : height}
+    children = entry_start + 78
+    if codec == 'h264':
+        config = _find(buf, children, entry_end, 'avcC')
+        if config:
+            start = config[0]
+            profile, compat, level = buf[start + 1], buf[start + 2], \
+                                     buf[start + 3]
+            name = _H264_PROFILES.get(profile)
+            if profile == 66 and compat & 0x40:
+                name = 'Constrained Baseline'
+            if name:
+                stream['profile'] = name
+            stream['level'] = level
+            chroma, depth = 1, 8
+            if profile in (100, 110, 122, 144, 244):
+                # The chroma format and bit depth follow the parameter sets.
+                pos = start + 6
+                for i in range(buf[start + 5] & 0x1f):
+                    pos += 2 + struct.unpack_from('>H', buf, pos)[0]
+                num_pps = buf[pos]
+                pos += 1
+                for i in range(num_pps):
+                    pos += 2 + struct.unpack_from('>H', buf, pos)[0]
+                if pos + 2 <= config[1]:
+                    chroma = buf[pos] & 3
+                    depth = (buf[pos + 1] & 7) + 8
+            stream['pix_fmt'] = _pix_fmt(chroma, depth)
+    elif codec == 'hevc':
+        config = _find(buf, children, entry_end, 'hvcC')
+        if config:
+            start = config[0]
+            name = _HEVC_PROFILES.get(buf[start + 1] & 0x1f)
+            if name:
+                stream['profile'] = name
+            stream['level'] = buf[start + 12]
+            stream['pix_fmt'] = _pix_fmt(buf[start + 16] & 3,
+                                         (buf[start + 17] & 7) + 8)
+    return stream
+
+def _pix_fmt(chroma, depth):
+    name = _CHROMA_FORMATS[chroma]
+    if depth == 8:
+        return name
+    return '{}{}le'.format(name, depth)
+
+def _audio_details(buf, entry_start, entry_end, codec, timescale):
+    # Return the ffprobe fields of an audio sample entry.
+    version, = struct.unpack_from('>H', buf, entry_start + 8)
+    if version > 1:
+        raise Unsupported('Audio sample entry version {}'.format(version))
+    channels, = struct.unpack_from('>H', buf, entry_start + 16)
+    sample_rate = struct.unpack_from('>I', buf, entry_start + 24)[0] >> 16
+    children = entry_start + (44 if version == 1 else 28)
+    if codec == 'aac':
+        esds = _find(buf, children, entry_end, 'esds')
+        if esds:
+            codec = _OBJECT_TYPES.get(_object_type(buf, esds), codec)
+    return {'codec_type' : 'audio', 'codec_name' : codec,
+            'sample_rate' : str(sample_rate if sample_rate else timescale),
+            'channels' : channels}
+
+def _track(buf, trak, movie_timescale):
+    # Return the ffprobe stream fields of a track, its start time in seconds
+    # and, for video, its keyframe times in seconds. Returns None for a track
+    # that's neither video nor audio.
+    start, end = trak
+    handler = _need(buf, start, end, 'mdia', 'hdlr')
+    kind = bytes(buf[handler[0] + 8:handler[0] + 12]).decode('latin-1')
+    if kind not in ('vide', 'soun'):
+        return None
+
+    timescale, duration = _timing(buf, _need(buf, start, end, 'mdia',
+                                             'mdhd')[0])
+    stbl = _need(buf, start, end, 'mdia', 'minf', 'stbl')
+    stsd = _need(buf, stbl[0], stbl[1], 'stsd')
+    entry_type, entry_start, entry_end = next(_boxes(buf, stsd[0] + 8,
+                                                     stsd[1]))
+    codec = CODECS.get(entry_type)
+    if not codec:
+        raise Unsupported('Unknown sample entry {}'.format(entry_type))
+    if kind == 'vide':
+        stream = _video_details(buf, entry_start, entry_end, codec)
+        stream['codec_name'] = codec
+    else:
+        stream = _audio_details(buf, entry_start, entry_end, codec, timescale)
+
+    stts = _runs(buf, _need(buf, stbl[0], stbl[1], 'stts'))
+    samples = sum(count for count, delta in stts)
+    media_duration = sum(count * delta for count, delta in stts)
+    if not samples or not media_duration:
+        raise Unsupported('Track without samples, such as a fragmented file')
+
+    stsz = _find(buf, stbl[0], stbl[1], 'stsz')
+    if not stsz:
+        raise Unsupported('No stsz box')
+    size, count = struct.unpack_from('>II', buf, stsz[0] + 4)
+    data_size = size * count if size else sum(_table(buf, stsz[0] + 12,
+                                                     count))
+
+    stream['time_base'] = '1/{}'.format(timescale)
+    stream['bit_rate'] = str(data_size * 8 * timescale // media_duration)
+    stream['duration'] = '{:.6f}'.format(duration / timescale)
+    stream['nb_frames'] = str(samples)
+    if kind == 'vide':
+        avg = fractions.Fraction(samples * timescale, media_duration)
+        delta = max(stts, key=lambda run: run[0])[1]
+        rate = fractions.Fraction(timescale, delta) if delta else avg
+        stream['avg_frame_rate'] = '{}/{}'.format(avg.numerator,
+                                                  avg.denominator)
+        stream['r_frame_rate'] = '{}/{}'.format(rate.numerator,
+                                                rate.denominator)
+
+    # An edit list can delay the track with an empty edit and skip media
+    # before a media time, such as B-frame delay or audio priming.
+    empty = 0
+    media_time = 0
+    elst = _find(buf, start, end, 'edts', 'elst')
+    if elst:
+        fmt = '>Qq' if buf[elst[0]] == 1 else '>Ii'
+        entry_size = struct.calcsize(fmt) + 4
+        entries, = struct.unpack_from('>I', buf, elst[0] + 4)
+        for i in range(entries):
+            segment, media = struct.unpack_from(fmt, buf,
+                                                elst[0] + 8 + i * entry_size)
+            if media == -1:
+                empty += segment / movie_timescale
+            else:
+                media_time = media
+                break
+
+    ctts_box = _find(buf, stbl[0], stbl[1], 'ctts')
+    ctts = _runs(buf, ctts_box) if ctts_box else [(samples, 0)]
+    # Media skipped by the edit list, such as audio priming, isn't shown, so
+    # the track starts once the edit does.
+    first = min(_sample_times(stts, ctts, range(1, min(samples, 32) + 1)))
+    track_start = empty + max(first - media_time, 0) / timescale
+    if kind != 'vide':
+        return stream, track_start, None
+
+    # Without a sync sample table, every sample is a keyframe.
+    stss = _find(buf, stbl[0], stbl[1], 'stss')
+    if stss:
+        count, = struct.unpack_from('>I', buf, stss[0] + 4)
+        sync = sorted(_table(buf, stss[0] + 8, count))
+    else:
+        sync = range(1, samples + 1)
+    keyframes = sorted(empty + (t - media_time) / timescale
+                       for t in _sample_times(stts, ctts, sync))
+    return stream, track_start, keyframes
+
+def _sample_times(stts, ctts, numbers):
+    # Return the composition times, in the track's timescale, of the samples
+    # with the given sorted 1-based numbers.
+    times = []
+    stts = iter(stts)
+    ctts = iter(ctts)
+    dts = 0
+    time_count, delta = 0, 0
+    offset_count, offset = 0, 0
+    sample = 1
+    for number in numbers:
+        while sample < number or not time_count or not offset_count:
+            if not time_count:
+                time_count, delta = next(stts)
+                continue
+            if not offset_count:
+                offset_count, offset = next(ctts, (sys.maxsize, 0))
+                continue
+            # Skip ahead by as many samples as the current runs allow.
+            step = min(number - sample, time_count, offset_count)
+            dts += step * delta
+            time_count -= step
+            offset_count -= step
+            sample += step
+        times.append(dts + offset)
+    return times
+
+def read(filename):
+    '''Read the metadata of the MP4 or MOV file *filename* and return a tuple
+    of a dict in the form of ffprobe's JSON output, with the stream and format
+    fields that `common.probe_video()` and `common.encode_args()` use, and a
+    sorted list of the keyframe times of the first video stream in
+    milliseconds, relative to the start of the file. Raises `Unsupported` for
+    files we can't read, such as other formats or fragmented MP4.'''
+
+    try:
+        with open(filename, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _read(buf)
+    except (ValueError, IndexError, StopIteration, struct.error) as e:
+        raise Unsupported(str(e))
+
+def _read(buf):
+    moov = _need(buf, 0, len(buf), 'moov')
+    movie_timescale, duration = _timing(buf, _need(buf, moov[0], moov[1],
+                                                   'mvhd')[0])
+    if not movie_timescale or not duration:
+        raise Unsupported('No movie duration')
+
+    streams = []
+    starts = []
+    keyframes = None
+    for kind, start, end in _boxes(buf, moov[0], moov[1]):
+        if kind != 'trak':
+            continue
+        track = _track(buf, (start, end), movie_timescale)
+        if not track:
+            continue
+        stream, track_start, track_keyframes = track
+        stream['index'] = len(streams)
+        streams.append(stream)
+        starts.append(track_start)
+        if keyframes is None and stream['codec_type'] == 'video':
+            keyframes = track_keyframes
+    if keyframes is None:
+        raise Unsupported('No video track')
+
+    start_time = min(starts)
+    duration = duration / movie_timescale
+    data = {'streams' : streams,
+            'format' : {'duration' : '{:.6f}'.format(duration),
+                        'start_time' : '{:.6f}'.format(start_time),
+                        'size' : str(len(buf)),
+                        'bit_rate' : str(int(len(buf) * 8 / duration)),
+                        'nb_streams' : len(streams)}}
+    return data, [round((k - start_time) * 1000, 3) for k in keyframes]
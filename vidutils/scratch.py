@@ -0,0 +1,152 @@
+'''Manage a scratch directory of intermediate files, keyed by the inputs and
+arguments of the ffmpeg command that made them, so unchanged steps are reused
+across runs and interrupted runs can resume.'''
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import common
+
+_log = logging.getLogger(__name__)
+
+# Default scratch directory and the size in bytes beyond which the least
+# recently used intermediate files are evicted.
+SCRATCH_DIR = os.environ.get('VIDUTILS_SCRATCH_DIR',
+                             os.path.join(common.CACHE_DIR, 'scratch'))
+SCRATCH_SIZE = int(os.environ.get('VIDUTILS_SCRATCH_SIZE', 20 * 1024 ** 3))
+
+_PARTIAL = '.partial'
+
+# Without file locks, partial files not written to for this many seconds are
+# taken to be left by interrupted commands.
+_PARTIAL_AGE = 24 * 60 * 60
+
+def _fingerprint(filename, scratch_dir):
+    # Files in the scratch directory are named by their key already, and their
+    # mtime changes as they're used, so we use the name alone.
+    if os.path.dirname(os.path.abspath(filename)) == os.path.abspath(
+            scratch_dir):
+        return os.path.basename(filename)
+    if os.path.exists(filename):
+        return common.file_key(filename, 'artifact')
+    return filename
+
+def artifact_path(args, scratch_dir=SCRATCH_DIR, suffix='.mp4'):
+    '''Return the path in *scratch_dir* for the output of the ffmpeg command
+    *args*, keyed by the fingerprints of its input files and all of its other
+    arguments. The last argument, the output filename, is ignored.'''
+
+    key_args = list(args[:-1])
+    for i, arg in enumerate(key_args[:-1]):
+        if arg == '-i':
+            key_args[i + 1] = _fingerprint(key_args[i + 1], scratch_dir)
+    key = hashlib.sha1(json.dumps(key_args).encode('utf-8')).hexdigest()
+    return os.path.join(scratch_dir, key + suffix)
+
+def run_artifact(args, stage=None, make=None):
+    '''Run the ffmpeg command *args*, whose output filename is a path from
+    `artifact_path()`, unless that file already exists from an earlier run.
+    The output is written under a partial name and renamed once complete, so
+    an interrupted command is never reused. If *make* is given, it's called
+    with the partial name to write the file instead of running *args*.'''
+
+    path = args[-1]
+    if os.path.exists(path):
+        _log.info('Reusing %s for stage %s', path, stage)
+        os.utime(path)
+        return path
+
+    # The partial file stays locked while it's written, so eviction in other
+    # runs can tell it from one left by an interrupted command.
+    root, ext = os.path.splitext(path)
+    partial = root + _PARTIAL + ext
+    with open(partial, 'ab') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            # Another run made it while we waited for the lock.
+            return path
+        if make:
+            make(partial)
+        else:
+            common.run_command(args[:-1] + [partial], stage)
+        os.replace(partial, path)
+    return path
+
+def _in_use(partial):
+    # Whether a running command is still writing the partial file.
+    if not fcntl:
+        return time.time() - os.path.getmtime(partial) < _PARTIAL_AGE
+    with open(partial, 'rb') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+def estimate_bytes(fields, seconds):
+    '''Estimate the bytes needed for *seconds* of the video whose
+    `common.probe_video()` *fields* are given, from its overall bitrate.'''
+
+    bitrate = fields['probe']['format'].get('bit_rate')
+    if not bitrate:
+        bitrate = fields['bitrate'] * 1000
+    return int(int(bitrate) * seconds / 8)
+
+def evict(scratch_dir=SCRATCH_DIR, budget=SCRATCH_SIZE, keep=()):
+    '''Remove the least recently used files in *scratch_dir* until they take
+    at most *budget* bytes. The files in *keep*, which the current run uses,
+    and the partial files of running commands count towards the total but are
+    kept. Partial files left by interrupted commands are removed.'''
+
+    keep = {os.path.abspath(p) for p in keep}
+    entries = []
+    total = 0
+    for entry in os.scandir(scratch_dir):
+        if not entry.is_file():
+            continue
+        partial = _PARTIAL in entry.name
+        try:
+            if partial and not _in_use(entry.path):
+                _log.info('Removing stale %s from scratch space', entry.path)
+                os.remove(entry.path)
+                continue
+            st = entry.stat()
+        except FileNotFoundError:
+            # Finished or removed by another run since we listed it.
+            continue
+        total += st.st_size
+        if not partial and os.path.abspath(entry.path) not in keep:
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    for mtime, size, path in sorted(entries):
+        if total <= budget:
+            break
+        _log.info('Evicting %s from scratch space', path)
+        os.remove(path)
+        total -= size
+
+def prepare(needed, scratch_dir=SCRATCH_DIR, budget=SCRATCH_SIZE, keep=()):
+    '''Make *scratch_dir* ready for *needed* more bytes of intermediate files,
+    evicting old files other than those in *keep* to stay within *budget* and
+    exiting with an error if there isn't enough free disk space.'''
+
+    os.makedirs(scratch_dir, exist_ok=True)
+    evict(scratch_dir, max(budget - needed, 0), keep)
+    free = shutil.disk_usage(scratch_dir).free
+    if needed > free:
+        _log.error('Need about %d MB of scratch space in %s but only %d MB is '
+                   'free', needed // 1024 ** 2, scratch_dir,
+                   free // 1024 ** 2)
+        sys.exit(1)
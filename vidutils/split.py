@@ -9,18 +9,100 @@ import os
 import os.path
 import sys
 
-from . import common
+from . import analyze, common
 
-_log = logging.getLogger()
-_log.setLevel(logging.INFO)
-_log.addHandler(logging.StreamHandler())
+_log = logging.getLogger(__name__)
 
+def interval_times(duration, interval, start=None, end=None):
+    '''Return split times as `datetime.timedelta` objects every *interval*
+    from *start* until *end*, or the video *duration* if *end* is None.
+    Raises ValueError if *interval* isn't positive.'''
+
+    if interval <= datetime.timedelta(0):
+        raise ValueError('Split interval must be positive')
+    times = []
+    begin = start if start else datetime.timedelta(0)
+    end = end if end else duration
+    time = begin + interval
+    while time < end:
+        times.append(time)
+        time += interval
+    return times
+
+def part_bounds(split_times, start=None, end=None):
+    '''Return a list of (begin, end) `datetime.timedelta` pairs, one for each
+    output part made by splitting at the `datetime.timedelta` values in
+    *split_times*. The begin of the first part is *start* and the end of the
+    last part is *end*, where None means the start or end of the video.'''
+
+    split_times = sorted(split_times)
+    begins = [start] + split_times
+    ends = split_times + [end]
+    return list(zip(begins, ends))
+
+def split_video(filename, prefix, bounds):
+    '''Split *filename* into parts named "{prefix}N.mp4" in a single ffmpeg
+    pass with the segment muxer. *bounds* is a list of (begin, end) pairs as
+    returned by `part_bounds()`. We seek on the input side so that ffmpeg
+    doesn't have to demux and discard everything before the first part.
+    *filename* can be "-" to read from stdin.'''
+
+    first_begin = bounds[0][0]
+    last_end = bounds[-1][1]
+    offset = first_begin if first_begin else datetime.timedelta(0)
+
+    ffmpeg_args = ['ffmpeg']
+    if first_begin:
+        ffmpeg_args += ['-ss', str(first_begin.total_seconds())]
+    ffmpeg_args += ['-i', common.input_url(filename)]
+    if last_end:
+        ffmpeg_args += ['-t', str((last_end - offset).total_seconds())]
+    ffmpeg_args += ['-map', '0', '-c', 'copy']
+
+    # Segment times are relative to the output, which begins at offset.
+    segment_times = [str((begin - offset).total_seconds())
+                     for begin, end in bounds[1:]]
+    if not segment_times:
+        ffmpeg_args.append('{}1.mp4'.format(prefix))
+        common.run_command(ffmpeg_args, 'split_video')
+        return
+
+    ffmpeg_args += ['-f', 'segment', '-segment_times', ','.join(segment_times),
+                    '-segment_start_number', '1', '-reset_timestamps', '1',
+                    '{}%d.mp4'.format(prefix.replace('%', '%%'))]
+    common.run_command(ffmpeg_args, 'split_video')
+
+def split_parts(filename, prefix, bounds, jobs, threads=None):
+    '''Split *filename* into parts named "{prefix}N.mp4" with a separate ffmpeg
+    process for each part, running at most *jobs* processes at once. Each
+    process seeks on the input side to the start of its part. *threads* limits
+    the threads used by each ffmpeg process, defaulting to an even share of the
+    available cores. If any part fails, the other parts being written are
+    stopped, and the parts left unfinished are removed.'''
+
+    if not threads:
+        threads = max(1, (os.cpu_count() or 1) // jobs)
+
+    commands = []
+    for i, (begin, end) in enumerate(bounds):
+        ffmpeg_args = ['ffmpeg']
+        if begin:
+            ffmpeg_args += ['-ss', str(begin.total_seconds())]
+        ffmpeg_args += ['-i', filename]
+        if end:
+            duration = end - (begin if begin else datetime.timedelta(0))
+            ffmpeg_args += ['-t', str(duration.total_seconds())]
+        ffmpeg_args += ['-map', '0', '-c', 'copy', '-threads', str(threads),
+                        '{}{}.mp4'.format(prefix, i + 1)]
+        commands.append(ffmpeg_args)
+    common.run_parallel(commands, jobs, 'split_parts', remove_failed=True)
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('input_file', nargs=1, metavar='<filename>',
-                        help='An mp4 video file to split into multiple files')
-    parser.add_argument("split_times", nargs='+', metavar="<time>",
+                        help='An mp4 video file to split into multiple '
+                        'files, or - to read from stdin')
+    parser.add_argument("split_times", nargs='*', metavar="<time>",
                         help="Time at which to split the video")
     parser.add_argument('-p', dest='output_prefix', metavar='<prefix>',
                         default=None, help='Output video filename prefix')
@@ -28,22 +110,69 @@ def main():
             default=None, help='Trim video before the given time')
     parser.add_argument('-e', dest='end', metavar='<time>',
             default=None, help='Trim video after the given time')
-    args = parser.parse_args()
+    parser.add_argument('-n', dest='every_minutes', metavar='N', type=float,
+            default=None, help='Split the video every N minutes')
+    parser.add_argument('-b', dest='max_bytes', metavar='N', type=int,
+            default=None, help='Split the video into parts of at most about N '
+            'bytes, estimated from the average byte rate of the video')
+    parser.add_argument('-c', dest='snap', metavar='<seconds>', type=float,
+            default=None, help='Move each split time to the nearest black '
+            'frame or the biggest scene change within this many seconds '
+            '(needs NumPy)')
+    parser.add_argument('-j', dest='jobs', metavar='N', type=int, default=1,
+            help='Write N parts at once with separate ffmpeg processes')
+    parser.add_argument('-t', dest='threads', metavar='N', type=int,
+            default=None, help='Threads for each ffmpeg process with -j')
+    # Split times can follow the options, as when they were required.
+    args = parser.parse_intermixed_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    common.set_tool('vid-split')
+
+    schedules = [s for s in (args.split_times, args.every_minutes,
+                             args.max_bytes) if s is not None and s != []]
+    if len(schedules) != 1:
+        _log.error('Give exactly one of split times, -n or -b')
+        sys.exit(1)
+    if schedules[0] != args.split_times and schedules[0] <= 0:
+        _log.error('The value of -n or -b must be positive')
+        sys.exit(1)
+
+    filename = args.input_file[0]
+    if common.is_pipe(filename) and (not args.split_times or args.snap or
+                                     args.jobs > 1):
+        # A pipe can't be probed or read more than once.
+        _log.error('Only split times can be given when reading from a pipe, '
+                   'without -c or -j')
+        sys.exit(1)
+    start = common.parse_time(args.start) if args.start else None
+    end = common.parse_time(args.end) if args.end else None
+    if args.split_times:
+        split_times = [common.parse_time(t) for t in args.split_times]
+    else:
+        duration = common.parse_time(
+            common.probe_video(filename)['duration'])
+        if args.every_minutes:
+            interval = datetime.timedelta(minutes=args.every_minutes)
+        else:
+            byte_rate = os.path.getsize(filename) / duration.total_seconds()
+            interval = datetime.timedelta(seconds=args.max_bytes / byte_rate)
+        split_times = interval_times(duration, interval, start, end)
+
+    if args.snap:
+        fps = common.probe_video(filename)['fps']
+        split_times = [datetime.timedelta(seconds=analyze.snap_to_cut(
+                           filename, t.total_seconds(), args.snap, fps))
+                       for t in split_times]
 
     prefix = args.output_prefix
     if not prefix:
-        prefix = os.path.basename(args.input_file[0]) + "_part"
-    for i in range(0, len(args.split_times) + 1):
-        ffmpeg_args = ["ffmpeg", "-i", args.input_file[0]]
-        if args.start and i == 0:
-            ffmpeg_args += ["-ss", args.start]
-        elif i > 0:
-            ffmpeg_args += ["-ss", args.split_times[i - 1]]
-        if args.end and i == len(args.split_times):
-            ffmpeg_args += ["-to", args.end]
-        elif i < len(args.split_times):
-            ffmpeg_args += ["-to", args.split_times[i]]
-        out_file = "{}{}.mp4".format(prefix, i + 1)
-        ffmpeg_args += ["-map", "0", "-acodec", "copy", "-vcodec", "copy",
-                out_file]
-        common.run_command(ffmpeg_args)
+        prefix = 'stdin' if filename == '-' else os.path.basename(filename)
+        prefix += "_part"
+    bounds = part_bounds(split_times, start, end)
+    if args.jobs > 1:
+        split_parts(filename, prefix, bounds, args.jobs, args.threads)
+    else:
+        split_video(filename, prefix, bounds)
+
+if __name__ == '__main__':
+    main()
@@ -3,20 +3,164 @@
 """Adjust an audio channel in segments and merge it with another."""
 
 import argparse
-import datetime
+import bisect
+import fractions
+import heapq
 import logging
+import math
+import os
 import subprocess
 import sys
 
-from . import common
+from . import analyze, common
 
-_log = logging.getLogger()
-_log.setLevel(logging.INFO)
-_log.addHandler(logging.StreamHandler())
+_log = logging.getLogger(__name__)
+
+# Audio packets encoded on either side of a spliced window, so encoder delay
+# and padding land outside it.
+_SPLICE_PREROLL = 2
+
+def parse_segment(segment):
+    '''Parse an audio segment given as "<time>-<time>" into a (start, stop)
+    pair of seconds. A segment that's already a pair of numbers is returned
+    as-is.'''
+
+    if not isinstance(segment, str):
+        return tuple(segment)
+
+    start, stop = segment.split("-")
+    return (common.parse_time(start).total_seconds(),
+            common.parse_time(stop).total_seconds())
+
+def parse_volume(volume):
+    '''Parse an ffmpeg volume level, either a multiplier or a value in dB like
+    "6dB", into a multiplier. Any other level, such as an expression like
+    "1/3", is returned as a string for ffmpeg to evaluate.'''
+
+    volume = str(volume).strip()
+    try:
+        if volume.lower().endswith('db'):
+            return 10 ** (float(volume[:-2]) / 20)
+        return float(volume)
+    except ValueError:
+        pass
+    # The level goes in a list of asendcmd commands, so it can't contain
+    # their separators or quotes.
+    if not volume or any(c in volume for c in ",;'\\"):
+        raise ValueError('Invalid volume level: {!r}'.format(volume))
+    return volume
+
+def read_segments(filename):
+    '''Read audio segments from *filename*, one "<time>-<time> [<volume>]" per
+    line, ignoring blank lines and lines starting with "#". Returns a list of
+    (segment, volume) pairs, where volume is None if not given.'''
+
+    segments = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            segments.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return segments
+
+def read_rules(filename):
+    '''Read volume rules from *filename*, one "<channel> <time>-<time>
+    [<volume>]" per line, ignoring blank lines and lines starting with "#".
+    Returns a list of (channel, segment, volume) tuples, where volume is None
+    if not given.'''
+
+    rules = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            rules.append((int(fields[0]), fields[1],
+                          fields[2] if len(fields) > 2 else None))
+    return rules
+
+def normalize_segments(audio_segs, volume_levs):
+    '''Return the audio segments in *audio_segs* with the volume levels in
+    *volume_levs* as a sorted list of non-overlapping (start, stop, volume)
+    tuples, with start and stop in seconds and volume as a multiplier. Where
+    segments overlap, the volume of the segment given last is used, and
+    adjacent segments with the same volume are merged.'''
+
+    # Sweep over the segment boundaries, tracking the active segments in a heap
+    # by their position in the list so the last one given is on top.
+    events = []
+    for i, (seg, vol) in enumerate(zip(audio_segs, volume_levs)):
+        start, stop = parse_segment(seg)
+        if stop > start:
+            events.append((start, stop, i, parse_volume(vol)))
+    events.sort()
+
+    segments = []
+    active = []
+    points = sorted(set([e[0] for e in events] + [e[1] for e in events]))
+    j = 0
+    for begin, end in zip(points, points[1:]):
+        while j < len(events) and events[j][0] <= begin:
+            start, stop, i, vol = events[j]
+            heapq.heappush(active, (-i, stop, vol))
+            j += 1
+        # Ended segments are only dropped once they reach the top of the heap,
+        # since only the top one matters.
+        while active and active[0][1] <= begin:
+            heapq.heappop(active)
+        if not active:
+            continue
+        vol = active[0][2]
+        if segments and segments[-1][1] == begin and segments[-1][2] == vol:
+            segments[-1] = (segments[-1][0], end, vol)
+        else:
+            segments.append((begin, end, vol))
+    return segments
+
+def volume_filter(segments, name='gain'):
+    '''Return an audio filter chain applying the volume levels in *segments*,
+    as returned by `normalize_segments()`. Rather than a volume filter for
+    each segment, a single volume filter named "volume@*name*" is driven by
+    asendcmd, so the cost per audio frame stays small as segments grow.'''
+
+    if not segments:
+        return 'anull'
+
+    target = 'volume@{}'.format(name)
+    commands = ['{}-{} [enter] {} volume {}, [leave] {} volume 1'.format(
+                    start, stop, target, vol, target)
+                for start, stop, vol in segments]
+    return "asendcmd=c='{}',{}".format(';'.join(commands), target)
 
 def edit_volume(input_file, num_chan, output_file, audio_segs, volume_levs,
-        target_chan, do_merge, exclude_chans):
-    '''Build the audio volume filter and run ffmpeg.'''
+        target_chan, do_merge, exclude_chans, stream_format=None):
+    '''Adjust the volume of *target_chan* in the *audio_segs* to the
+    *volume_levs*, merging it with the other channels not in *exclude_chans*
+    if *do_merge* is True, with `edit_volumes()`.'''
+
+    rules = {target_chan : list(zip(audio_segs, volume_levs))}
+    merge_groups = None
+    if do_merge:
+        merge_groups = [[n for n in range(1, num_chan + 1)
+                         if n not in exclude_chans and n != target_chan] +
+                        [target_chan]]
+    edit_volumes(input_file, num_chan, output_file, rules, merge_groups,
+                 stream_format)
+
+def edit_volumes(input_file, num_chan, output_file, rules, merge_groups=None,
+        stream_format=None):
+    '''Build the audio volume filters and run ffmpeg once for all of them.
+    *rules* maps each audio channel, numbered from 1, to a list of (segment,
+    volume) pairs to adjust in that channel. If *merge_groups* is given as a
+    list of lists of channels, the output has one audio channel for each
+    group, merging its channels in order, and channels in no group are left
+    out. Otherwise every channel is kept. Channels that aren't edited or merged
+    are copied. *input_file* and *output_file* can be "-" for stdin and
+    stdout, and *stream_format* is as for `common.output_args()`. Raises
+    ValueError if *rules* edits a channel that's left out.'''
 
     # Argument order matters for ffmpeg per the synopsis:
 
@@ -26,71 +170,259 @@ def edit_volume(input_file, num_chan, output_file, audio_segs, volume_levs,
     # Input file (and end of input args), then start output args with
     # copying the video codec.
 
-    volume_statements = []
-    ffmpeg_args = ["ffmpeg", "-i", input_file, "-vcodec", "copy"]
-    for i, m in enumerate(audio_segs):
-        start, stop = m.split("-")
-        start_h, start_m, start_s = [int(x) for x in start.split(":")]
-        start_delta = datetime.timedelta(seconds=start_s, minutes=start_m,
-                                         hours=start_h)
-        stop_h, stop_m, stop_s = [int(x) for x in stop.split(":")]
-        stop_delta = datetime.timedelta(seconds=stop_s, minutes=stop_m,
-                hours=stop_h)
-
-        # Add a filter statement to adjust the volume in the audio duration.
-        statement = "volume=enable='between(t,{},{})':volume={}".format(
-                int(start_delta.total_seconds()),
-                int(stop_delta.total_seconds()), volume_levs[i])
-        volume_statements.append(statement)
+    ffmpeg_args = ["ffmpeg", "-i", common.input_url(input_file), "-vcodec",
+                   "copy"]
+    if merge_groups:
+        outputs = merge_groups
+    else:
+        outputs = [[n] for n in range(1, num_chan + 1)]
+    kept = set(n for group in outputs for n in group)
+    for n in sorted(rules):
+        if rules[n] and n not in kept:
+            raise ValueError("Channel {} has volume rules but isn't in any "
+                             "merge group".format(n))
 
+    # Edit each channel that's kept with its own volume filter, so its
+    # commands don't go to the filters of other channels.
+    filters = []
+    sources = {}
+    for n in sorted(kept):
+        sources[n] = "0:a:{}".format(n - 1)
+        if not rules.get(n):
+            continue
 
-    filter = "[0:a:{}]{}[aedit]".format(target_chan - 1,
-        ",".join(volume_statements))
+        segments = normalize_segments([seg for seg, vol in rules[n]],
+                                      [vol for seg, vol in rules[n]])
+        _log.info('Adjusting volume of channel %d in %d segment(s)', n,
+                  len(segments))
+        filters.append("[0:a:{}]{}[aedit{}]".format(n - 1,
+            volume_filter(segments, "gain{}".format(n)), n))
+        sources[n] = "[aedit{}]".format(n)
 
     map_args = ["-map", "0:v"]
-    if do_merge:
-        filter += ";"
-        num_merge = num_chan - len(exclude_chans)
-        for n in range(1, num_chan + 1):
-            if n in exclude_chans or n is target_chan:
+    codec_args = []
+    for i, group in enumerate(outputs):
+        if len(group) == 1:
+            map_args += ["-map", sources[group[0]]]
+            if not sources[group[0]].startswith("["):
+                codec_args += ["-c:a:{}".format(i), "copy"]
                 continue
-
-            filter += "[0:a:{}]".format(n - 1)
-
-        # Make our merge filter to merge mic audio with the edited desktop
-        # audio.
-        filter += "[aedit]amerge=inputs={}[aout]".format(num_merge)
-        map_args += ["-map", "[aout]"]
-    else:
-        for n in range(1, num_chan + 1):
-            if n is target_chan:
-                map_args += ["-map", "[aedit]"]
-            else:
-                map_args += ["-map", "0:a:{}".format(n - 1)]
+        else:
+            # Make our merge filter to merge the channels in the group, such
+            # as mic audio with the edited desktop audio.
+            filters.append("{}amerge=inputs={}[amerge{}]".format("".join(
+                sources[n] if sources[n].startswith("[") else
+                "[{}]".format(sources[n]) for n in group), len(group), i))
+            map_args += ["-map", "[amerge{}]".format(i)]
+        # Set channels for the edited and merged audio.
+        codec_args += ["-ac:a:{}".format(i), "2"]
 
     # Add the stream filter and maps for video and edited audio.
-    ffmpeg_args += ["-filter_complex", filter] + map_args
+    if filters:
+        ffmpeg_args += ["-filter_complex", ";".join(filters)]
+    ffmpeg_args += map_args + codec_args
 
-    # Enable aac audio codec and set quality/channels.
-    ffmpeg_args += ["-strict", "-2", "-ac", "2"]
+    # Enable aac audio codec.
+    ffmpeg_args += ["-strict", "-2"]
 
     # Copy video codec and specify the output file.
-    ffmpeg_args += ["-vcodec", "copy", output_file]
+    ffmpeg_args += ["-vcodec", "copy"]
+    ffmpeg_args += common.output_args(output_file, stream_format)
+
+    common.run_command(ffmpeg_args, 'edit_volume')
+
+def splice_windows(segments, times, margin=0.5):
+    '''Return the sorted, non-overlapping (first, stop) ranges of audio
+    packet indices that cover the audio *segments* from `normalize_segments()`
+    with *margin* seconds added on either side. *times* is the sorted list of
+    the packet start times in seconds; a range includes its first packet but
+    not its stop packet.'''
+
+    windows = []
+    for start, stop, vol in segments:
+        first = max(bisect.bisect_right(times, start - margin) - 1, 0)
+        last = bisect.bisect_left(times, stop + margin)
+        if windows and first <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(last, windows[-1][1]))
+        else:
+            windows.append((first, last))
+    return windows
+
+def _seek_args(bounds, index, origin=0):
+    '''Return the ffmpeg input arguments seeking to the packet at *index*
+    in *bounds*, the packet start times in seconds, with times counted from
+    *origin*. There's no seeking to the first packet, so that stream-copying
+    keeps any encoder priming before it.'''
+
+    if not index:
+        return []
+    # Round down to the microseconds ffmpeg parses times in, so the packet or
+    # sample at the seek time is the first one kept rather than the last one
+    # dropped.
+    micros = math.floor((bounds[index] - origin) * 1000000)
+    return ["-ss", "{}.{:06d}".format(*divmod(micros, 1000000))]
+
+def _copy_args(index, count):
+    '''Return the ffmpeg output arguments stream-copying *count* packets
+    from the packet at *index* that `_seek_args()` seeks to, dropping any
+    packets before it that the seek lands on.'''
+
+    args = ["-frames:a", str(count)]
+    if index:
+        args = ["-copypriorss", "0"] + args
+    return args
+
+def splice_volume(input_file, num_chan, output_file, segments, target_chan,
+        audio_stream, delete_temp=True, stream_format=None):
+    '''Adjust the volume of the target channel like `edit_volume()`, but only
+    re-encode the audio in windows around the *segments* from
+    `normalize_segments()`. The audio between the windows is stream-copied,
+    and the pieces are spliced back into one audio track with the same packets
+    as the original outside the windows. *audio_stream* is the ffprobe stream
+    data for the target channel. *output_file* and *stream_format* are as for
+    `edit_volume()`, but the input must be a file.'''
+
+    stream_map = "0:a:{}".format(target_chan - 1)
+    packets = common.probe_packets(input_file, stream_map[2:])
+    if not packets:
+        raise ValueError("No audio packets in {}".format(input_file))
+    time_base = fractions.Fraction(audio_stream['time_base'])
+    start_time = fractions.Fraction(
+        common.probe_data(input_file)['format'].get('start_time', '0'))
+    # The start time of each packet relative to the start of the file, then
+    # the end of the last packet.
+    bounds = [pts * time_base - start_time for pts, dts, dur in packets]
+    bounds.append(bounds[-1] + packets[-1][2] * time_base)
+    count = len(packets)
+    windows = splice_windows(segments, [float(t) for t in bounds[:-1]])
+
+    # Edit lists trimming encoder priming and padding are written in the
+    # movie time scale, which has to be the sample rate to trim exact samples.
+    timescale_args = ["-movie_timescale", audio_stream['sample_rate']]
+
+    def temp_file(desc):
+        # MP4 rather than M4A, which can't hold codecs like MP3.
+        fh = common.make_temp_file(input_file, desc, delete=delete_temp)
+        temp_fhs.append(fh)
+        return fh.name
+
+    # Alternate copied pieces between the windows with re-encoded windows.
+    # Copied pieces are cut at packet boundaries by seeking to the first
+    # packet, dropping any earlier ones the seek lands on, and copying a
+    # packet count. Windows are encoded with a few packets of pre-roll on
+    # either side, so the encoder delay and padding fall outside them, and the
+    # packets lining up with the window are then cut out of the encode the
+    # same way.
+    temp_fhs = []
+    pieces = []
+    commands = []
+    cut_commands = []
+    position = 0
+    for first, stop in windows + [(count, count)]:
+        if first > position:
+            pieces.append(temp_file('audio'))
+            commands.append(["ffmpeg"] + _seek_args(bounds, position) +
+                            ["-i", input_file, "-map", stream_map, "-c",
+                             "copy"] +
+                            _copy_args(position, first - position) +
+                            timescale_args + ["-y", pieces[-1]])
+        if stop <= first:
+            break
+
+        # Shift the segments inside this window to the start of the encode.
+        enc_first = max(first - _SPLICE_PREROLL, 0)
+        enc_stop = min(stop + _SPLICE_PREROLL, count)
+        origin = bounds[enc_first] if enc_first else 0
+        begin, end = float(bounds[first]), float(bounds[stop])
+        window_segs = [(max(start, begin) - float(origin),
+                        min(stop_time, end) - float(origin), vol)
+                       for start, stop_time, vol in segments
+                       if stop_time > begin and start < end]
+        encoded = temp_file('audio-encode')
+        ffmpeg_args = ["ffmpeg"] + _seek_args(bounds, enc_first)
+        # Ending the input where the source's audio ends, rather than where
+        # its last packet is padded to, gives the last packet the same length.
+        ffmpeg_args += ["-t", str(float(bounds[enc_stop] - origin)), "-i",
+                        input_file, "-map", stream_map, "-af",
+                        volume_filter(window_segs)]
+        ffmpeg_args += common.audio_encode_args(audio_stream, 0)
+        commands.append(ffmpeg_args + ["-strict", "-2"] + timescale_args +
+                        ["-y", encoded])
 
-    common.run_command(ffmpeg_args)
+        pieces.append(temp_file('audio-edit'))
+        cut_commands.append(["ffmpeg"] +
+                            _seek_args(bounds, first, origin) +
+                            ["-i", encoded, "-map", "0:a", "-c", "copy"] +
+                            _copy_args(first, stop - first) +
+                            timescale_args + ["-y", pieces[-1]])
+        position = stop
+
+    try:
+        jobs = os.cpu_count() or 1
+        common.run_parallel(commands, jobs, 'splice_volume/pieces')
+        common.run_parallel(cut_commands, jobs, 'splice_volume/cut')
+
+        # Mux the spliced audio in place of the target channel, copying
+        # everything else. The concat demuxer starts the audio at zero, so
+        # it's offset back to where the first packet was, which keeps any
+        # encoder priming before the start of the video.
+        list_file = common.write_concat_list(pieces)
+        ffmpeg_args = ["ffmpeg", "-f", "concat", "-safe", "0", "-itsoffset",
+                       str(float(bounds[0])), "-i", list_file, "-i",
+                       input_file, "-map", "1:v"]
+        for n in range(1, num_chan + 1):
+            if n == target_chan:
+                ffmpeg_args += ["-map", "0:a"]
+            else:
+                ffmpeg_args += ["-map", "1:a:{}".format(n - 1)]
+        ffmpeg_args += ["-c", "copy"]
+        ffmpeg_args += common.output_args(output_file, stream_format)
+        try:
+            common.run_command(ffmpeg_args, 'splice_volume/mux')
+        finally:
+            os.remove(list_file)
+    finally:
+        for fh in temp_fhs:
+            fh.close()
+
+    if not common.is_pipe(output_file):
+        spliced = common.probe_packets(output_file, stream_map[2:])
+        if len(spliced) != count:
+            _log.warning("Spliced audio has %d packets instead of %d",
+                         len(spliced), count)
 
 def main():
 
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("input_file", nargs=1, metavar="<filename>",
-            help="mp4 video file")
-    parser.add_argument("audio_segments", nargs='+', metavar="<time>-<time>",
+            help="mp4 video file, or - to read from stdin")
+    parser.add_argument("audio_segments", nargs='*', metavar="<time>-<time>",
                         help="Segments in which to adjust the desktop audio.")
+    parser.add_argument("-f", dest="segments_file", metavar="<filename>",
+            default=None, help="Read segments from a file with one "
+            "'<time>-<time> [<volume>]' per line")
+    parser.add_argument("-R", dest="rules_file", metavar="<filename>",
+            default=None, help="Read segments for any channels from a file "
+            "with one '<channel> <time>-<time> [<volume>]' per line, editing "
+            "them all in one pass")
     parser.add_argument("-o", dest="output_file", metavar="<filename>",
-            default="out.mp4", help="Output filename")
+            default="out.mp4", help="Output filename, or - to write to "
+            "stdout")
+    parser.add_argument("-F", dest="stream_format", metavar="<format>",
+            choices=sorted(common.STREAM_FORMATS), default=None,
+            help="Write the output so it can be read while it's written, as "
+            "one of: {} (default for stdout or a FIFO: mp4)".format(
+                ", ".join(sorted(common.STREAM_FORMATS))))
+    parser.add_argument("-n", dest="num_channels", metavar="N", type=int,
+            default=None, help="Number of audio channels in the input, "
+            "needed when reading from a pipe, which can't be probed")
     parser.add_argument("-m", dest="do_merge", default=False,
             action='store_true', help="In a file with multiple channels, "
             "merge all non-excluded channels with the modified target channel")
+    parser.add_argument("-g", dest="merge_groups", metavar="N,N[,N...]",
+            action='append', default=None, help="Merge these channels into "
+            "one output channel. Give once for each output channel; channels "
+            "in no group are left out. Can't be used with -m")
     parser.add_argument("-c", dest="target_channel", metavar="N",
             default=1, type=int,
             help="In a file with multiple channels, target this channel for "
@@ -98,18 +430,47 @@ def main():
     parser.add_argument("-x", dest="exclude_channels", metavar="N[,N...]",
             default=None, help="In a file with multiple channels, exclude "
             "these channels from merge")
+    parser.add_argument("-A", dest="auto_threshold", metavar="<dB>",
+            type=float, default=None, help="Find segments where the target "
+            "channel is louder than this level in dBFS and adjust those "
+            "(needs NumPy)")
+    parser.add_argument("-H", dest="hysteresis", metavar="<dB>", type=float,
+            default=3.0, help="With -A, end a segment once the level drops "
+            "this far below the threshold")
+    parser.add_argument("-M", dest="min_duration", metavar="<seconds>",
+            type=float, default=1.0, help="With -A, ignore segments shorter "
+            "than this")
+    parser.add_argument("-S", dest="splice", default=False,
+            action='store_true', help="Re-encode only the audio around the "
+            "segments and copy the rest, splicing it back into one channel. "
+            "Can't be used with -m")
     parser.add_argument("-v", dest="volume", metavar="<volume>", default='0',
-                        help="Adjusted volume level")
-    args = parser.parse_args()
+                        help="Adjusted volume level, as a multiplier, a "
+                        "value in dB like '-6dB' or an ffmpeg expression")
+    # Segments can follow the options, as when they were required.
+    args = parser.parse_intermixed_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    common.set_tool('vid-volume')
 
-    vid_details = common.probe_video(args.input_file[0])
-    num_chan = vid_details["num_channels"]
-    print("Found {} audio channel(s) in file {}".format(num_chan,
-        args.input_file[0]))
+    if common.is_pipe(args.input_file[0]):
+        # A pipe can only be read once, by the ffmpeg command editing it.
+        if not args.num_channels:
+            _log.error("Give the number of audio channels with -n to read "
+                       "from a pipe")
+            sys.exit(1)
+        if args.splice or args.auto_threshold is not None:
+            _log.error("-S and -A can't be used when reading from a pipe")
+            sys.exit(1)
+        num_chan = args.num_channels
+    else:
+        vid_details = common.probe_video(args.input_file[0])
+        num_chan = vid_details["num_channels"]
+        _log.info("Found %d audio channel(s) in file %s", num_chan,
+                  args.input_file[0])
 
     target_chan = args.target_channel
     if target_chan < 1 or target_chan > num_chan:
-        _log.error("Invalid target channel number: %d", n)
+        _log.error("Invalid target channel number: %d", target_chan)
         sys.exit(1)
 
     exclude_chans = []
@@ -125,10 +486,77 @@ def main():
     if len(volume_levs) == 1:
         volume_levs = [args.volume for m in args.audio_segments]
     elif len(volume_levs) != len(args.audio_segments):
-        print("Error: Number of volume values in -v must match number of audio"
-                "segments")
+        _log.error("Error: Number of volume values in -v must match number "
+                   "of audio segments")
+        sys.exit(1)
+
+    audio_segs = list(args.audio_segments)
+    if args.segments_file:
+        for seg, vol in read_segments(args.segments_file):
+            audio_segs.append(seg)
+            volume_levs.append(vol if vol else args.volume.split(',')[0])
+    if args.auto_threshold is not None:
+        found = analyze.loudness_segments(args.input_file[0], target_chan,
+                args.auto_threshold, args.hysteresis, args.min_duration)
+        audio_segs += found
+        volume_levs += [args.volume.split(',')[0]] * len(found)
+    rules = {}
+    if audio_segs:
+        rules[target_chan] = list(zip(audio_segs, volume_levs))
+    if args.rules_file:
+        for n, seg, vol in read_rules(args.rules_file):
+            if n < 1 or n > num_chan:
+                _log.error("Invalid channel number in rules: %d", n)
+                sys.exit(1)
+            rules.setdefault(n, []).append(
+                (seg, vol if vol else args.volume.split(',')[0]))
+    if not rules:
+        _log.error("No audio segments given")
+        sys.exit(1)
+    for seg, vol in [r for n in rules for r in rules[n]]:
+        try:
+            parse_volume(vol)
+        except ValueError as e:
+            _log.error("Error: %s", e)
+            sys.exit(1)
+
+    merge_groups = None
+    if args.merge_groups:
+        if args.do_merge:
+            _log.error("-g can't be used with -m")
+            sys.exit(1)
+        merge_groups = [[int(n) for n in g.split(',')]
+                        for g in args.merge_groups]
+        grouped = [n for group in merge_groups for n in group]
+        for n in grouped:
+            if n < 1 or n > num_chan or grouped.count(n) > 1:
+                _log.error("Invalid channel number to merge: %d", n)
+                sys.exit(1)
+
+    if args.splice:
+        if args.do_merge or merge_groups or len(rules) > 1:
+            _log.error("Splicing can only edit one channel without merging")
+            sys.exit(1)
+        target_chan, = rules
+        segments = [seg for seg, vol in rules[target_chan]]
+        levels = [vol for seg, vol in rules[target_chan]]
+        streams = [s for s in vid_details['probe']['streams']
+                   if s.get('codec_type') == 'audio']
+        splice_volume(args.input_file[0], num_chan, args.output_file,
+                normalize_segments(segments, levels), target_chan,
+                streams[target_chan - 1], stream_format=args.stream_format)
+        return
+
+    if args.do_merge:
+        merge_groups = [[n for n in range(1, num_chan + 1)
+                         if n not in exclude_chans and n != target_chan] +
+                        [target_chan]]
+    try:
+        edit_volumes(args.input_file[0], num_chan, args.output_file, rules,
+                     merge_groups, args.stream_format)
+    except ValueError as e:
+        _log.error("Error: %s", e)
         sys.exit(1)
 
-    edit_volume(args.input_file[0], num_chan, args.output_file,
-            args.audio_segments, volume_levs, target_chan, args.do_merge,
-            exclude_chans)
+if __name__ == '__main__':
+    main()